@@ -1,20 +1,38 @@
 
 
 import argparse
+import contextlib
+import dataclasses
+import functools
+import hashlib
+import io
 import json
+import logging
 import os
+import shutil
+import struct
 import sys
+import tempfile
+import time
+import tracemalloc
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from pathlib import Path
+from typing import Optional
 
 try:
     import librosa
     import numpy as np
+    import soundfile as sf
+    import soxr
     from scipy.signal import find_peaks
 except ImportError:
     print("Error: Required packages not installed.")
-    print("Install with: pip install librosa numpy scipy")
+    print("Install with: pip install -r tools/requirements.txt")
     sys.exit(1)
 
+from chart_io import SONGS_DIR, read_chart
+from gameplay_sim import measured_rating
+
 # =============================================================================
 # GLOBAL TIMING CONSTANTS
 # Smaller hop_length = higher time resolution for onset detection.
@@ -23,21 +41,551 @@ except ImportError:
 # =============================================================================
 HOP_LENGTH = 256
 SR = 22050
+# The HPSS split runs on librosa.stft's default hop (n_fft 2048 / 4)
+HPSS_HOP_LENGTH = 512
+
+DIFFICULTIES = ['easy', 'normal', 'hard', 'expert']
+
+# Supported key modes (lanes per chart), see assign_lanes, and the Roku
+# remote button each lane is played with (GameplayScene uses the same map)
+LANE_COUNTS = [4, 5, 6, 7]
+LANE_KEY_NAMES = {
+    4: ['Left (←)', 'Up (↑)', 'Down (↓)', 'Right (→)'],
+    5: ['Left (←)', 'Up (↑)', 'OK (●)', 'Down (↓)', 'Right (→)'],
+    6: ['Rewind («)', 'Left (←)', 'Up (↑)', 'Down (↓)', 'Right (→)', 'Fast Fwd (»)'],
+    7: ['Rewind («)', 'Left (←)', 'Up (↑)', 'OK (●)', 'Down (↓)', 'Right (→)', 'Fast Fwd (»)'],
+}
+
+# Hit strength classes (see classify_hit_strength), stored as uint8 codes
+HIT_SOFT = 0
+HIT_MEDIUM = 1
+HIT_HARD = 2
+HIT_CLASS_NAMES = ['soft', 'medium', 'hard']
+
+# Notes as returned by generate_notes: one record per note, sorted by
+# (time, lane). duration is the hold length in seconds, 0 for taps.
+NOTE_DTYPE = np.dtype([
+    ('time', np.float32),
+    ('lane', np.uint8),
+    ('hit_class', np.uint8),
+    ('duration', np.float32),
+])
+
+# Pipeline progress goes to this logger. Library callers get nothing below
+# WARNING unless they configure logging; the CLI prints INFO to stdout.
+logger = logging.getLogger('beatmap_generator')
+
+# Analysis cache defaults (see AnalysisCache)
+DEFAULT_CACHE_DIR = '.beatmap_cache'
+DEFAULT_CACHE_SIZE_MB = 1024
+
+# Beatmap file formats (see save_beatmap)
+BEATMAP_FORMATS = ['legacy', 'compact', 'both']
+COMPACT_FORMAT_VERSION = 2
+
+
+
+# =============================================================================
+# Stage Profiling
+# generate_beatmap and generate_beat_aligned_notes wrap each pipeline stage
+# in profiler.stage(name). StageProfiler records wall time, CPU time and the
+# peak traced memory of each stage; NULL_PROFILER, the default, hands back
+# one shared no-op context so an unprofiled run pays nothing.
+# =============================================================================
+
+class StageProfiler:
+    """
+    Per-stage wall time, CPU time and peak memory for one or more runs.
+    
+    Use as a context manager; tracemalloc is traced only while it is open.
+    Stages nest: an outer stage's times and peak include its inner ones,
+    and the report indents inner stages under the stage that ran them.
+    Peak memory is the largest traced allocation total seen during the
+    stage (numpy buffers included), not the growth over its start.
+    """
+    
+    def __init__(self):
+        self.records = []
+        self._stack = []
+        self._owns_tracing = False
+    
+    def __enter__(self):
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._owns_tracing = True
+        return self
+    
+    def __exit__(self, *exc):
+        if self._owns_tracing:
+            tracemalloc.stop()
+            self._owns_tracing = False
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        record = {'stage': name, 'depth': len(self._stack)}
+        self.records.append(record)
+        
+        # The enclosing stage keeps the peak it reached before this one resets it
+        if self._stack:
+            parent = self._stack[-1]
+            parent['peak_bytes'] = max(parent['peak_bytes'], tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+        record['peak_bytes'] = 0
+        self._stack.append(record)
+        
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield
+        finally:
+            record['wall_s'] = time.perf_counter() - wall_start
+            record['cpu_s'] = time.process_time() - cpu_start
+            record['peak_bytes'] = max(record['peak_bytes'], tracemalloc.get_traced_memory()[1])
+            self._stack.pop()
+            if self._stack:
+                parent = self._stack[-1]
+                parent['peak_bytes'] = max(parent['peak_bytes'], record['peak_bytes'])
+    
+    def print_report(self):
+        """Print the recorded stages as a table, in the order they started."""
+        print("\n" + "="*62)
+        print("PROFILE")
+        print("="*62)
+        print(f"{'Stage':<30} {'Wall (s)':>9} {'CPU (s)':>9} {'Peak (MB)':>10}")
+        for record in self.records:
+            name = '  ' * record['depth'] + record['stage']
+            print(f"{name:<30} {record['wall_s']:>9.3f} {record['cpu_s']:>9.3f} "
+                  f"{record['peak_bytes'] / (1024 * 1024):>10.1f}")
+        top_level = [r for r in self.records if r['depth'] == 0]
+        print(f"{'total':<30} {sum(r['wall_s'] for r in top_level):>9.3f} "
+              f"{sum(r['cpu_s'] for r in top_level):>9.3f} "
+              f"{max((r['peak_bytes'] for r in top_level), default=0) / (1024 * 1024):>10.1f}")
+        print("="*62 + "\n")
+    
+    def stage_report(self):
+        """The recorded stages as JSON-ready dicts, in the order they started."""
+        return [
+            {
+                'stage': r['stage'],
+                'depth': r['depth'],
+                'wallSeconds': round(r['wall_s'], 6),
+                'cpuSeconds': round(r['cpu_s'], 6),
+                'peakMB': round(r['peak_bytes'] / (1024 * 1024), 3),
+            }
+            for r in self.records
+        ]
+    
+    def save_report(self, output_path, **metadata):
+        """Write the recorded stages, plus any metadata given, as JSON."""
+        report = dict(metadata)
+        report['stages'] = self.stage_report()
+        with open(output_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved profile to: {output_path}")
+
+
+class _NullProfiler:
+    """Stand-in for StageProfiler when profiling is off."""
+    
+    _stage = contextlib.nullcontext()
+    
+    def stage(self, name):
+        return self._stage
+
+
+NULL_PROFILER = _NullProfiler()
 
 
-def detect_bpm(y, sr):
+# =============================================================================
+# Shared Analysis Context
+# Every stage of the pipeline reads from the same handful of expensive
+# products (HPSS split, spectrograms, onset envelopes, beat frames).
+# AnalysisContext computes each one on first use and hands the cached
+# result to every later caller, so one generate_beatmap run never repeats
+# an STFT, an HPSS pass or a beat track.
+# =============================================================================
+
+ONSET_AGGREGATES = {
+    'mean': np.mean,
+    'median': np.median,
+    'max': np.max,
+}
+
+
+class AnalysisContext:
+    """
+    Lazily computed, shared analysis products for one decoded track.
+    
+    signal names used throughout:
+        'mix'        - the decoded audio as loaded
+        'harmonic'   - harmonic component of the HPSS split
+        'percussive' - percussive component of the HPSS split
+    
+    margin: HPSS separation margin (see separate_percussive).
+    """
+    
+    def __init__(self, y, sr, margin=3.0):
+        self.y = y
+        self.sr = sr
+        self.margin = margin
+        self.products = {}
+        # Set by load_analysis when the context is backed by AnalysisCache
+        self.cache_key = None
+        # Set by load_analysis; offset calibration reads the file's header
+        self.audio_path = None
+        # Lazily computed stages (HPSS) report here; see load_analysis
+        self.profiler = NULL_PROFILER
+    
+    def cached(self, key, compute):
+        """Return products[key], computing and storing it on first request."""
+        if key not in self.products:
+            self.products[key] = compute()
+        return self.products[key]
+    
+    def _hpss(self):
+        # Same steps as librosa.effects.hpss, but the harmonic and
+        # percussive spectra are kept so later stages can reuse them
+        with self.profiler.stage('hpss'):
+            stft = librosa.stft(self.y)
+            stft_harm, stft_perc = librosa.decompose.hpss(stft, margin=self.margin)
+        self.products['hpss_harmonic_stft'] = stft_harm
+        self.products['hpss_percussive_stft'] = stft_perc
+    
+    def hpss_spectrum(self, component):
+        """Complex HPSS spectrum ('harmonic' or 'percussive') at librosa's default hop."""
+        key = f'hpss_{component}_stft'
+        if key not in self.products:
+            self._hpss()
+        return self.products[key]
+    
+    def signal(self, name='mix'):
+        """Return the time-domain signal for 'mix', 'harmonic' or 'percussive'."""
+        if name == 'mix':
+            return self.y
+        return self.cached(name, lambda: librosa.istft(
+            self.hpss_spectrum(name),
+            dtype=self.y.dtype,
+            length=len(self.y)
+        ))
+    
+    def harmonic_energy(self):
+        """Mean power per frame of the harmonic HPSS spectrum, at HPSS_HOP_LENGTH."""
+        return self.cached('harmonic_energy', lambda: np.mean(
+            np.abs(self.hpss_spectrum('harmonic')) ** 2, axis=0
+        ))
+    
+    @property
+    def y_harmonic(self):
+        return self.signal('harmonic')
+    
+    @property
+    def y_percussive(self):
+        return self.signal('percussive')
+    
+    def power_spectrogram(self, signal='mix'):
+        """|STFT|^2 of a signal at HOP_LENGTH, shared by every onset envelope."""
+        return self.cached(f'power:{signal}', lambda: np.abs(librosa.stft(
+            self.signal(signal),
+            hop_length=HOP_LENGTH
+        )) ** 2)
+    
+    def mel_db(self, signal='mix', fmax=None):
+        """Log-power mel spectrogram, equivalent to what onset_strength builds internally."""
+        if fmax is None:
+            fmax = 0.5 * self.sr
+        return self.cached(f'mel_db:{signal}:{fmax:g}', lambda: librosa.power_to_db(np.abs(
+            librosa.feature.melspectrogram(
+                S=self.power_spectrogram(signal),
+                sr=self.sr,
+                n_mels=128,
+                fmax=fmax
+            )
+        )))
+    
+    def onset_envelope(self, signal='mix', aggregate='mean', fmax=None):
+        """Onset strength envelope for a signal at HOP_LENGTH resolution."""
+        key = f'onset_env:{signal}:{aggregate}:{fmax}'
+        return self.cached(key, lambda: librosa.onset.onset_strength(
+            S=self.mel_db(signal, fmax=fmax),
+            sr=self.sr,
+            hop_length=HOP_LENGTH,
+            aggregate=ONSET_AGGREGATES[aggregate]
+        ))
+    
+    def beats(self, signal='mix'):
+        """Return (tempo, beat_frames) for a signal, tracked once."""
+        if f'beat_frames:{signal}' not in self.products:
+            # beat_track uses a median-aggregated envelope when given raw audio
+            onset_env = self.onset_envelope(signal, aggregate='median')
+            tempo, beat_frames = librosa.beat.beat_track(
+                onset_envelope=onset_env,
+                sr=self.sr,
+                hop_length=HOP_LENGTH,
+                bpm=estimate_tempo(onset_env, self.sr)
+            )
+            # librosa returns either a scalar or array depending on version
+            self.products[f'tempo:{signal}'] = np.atleast_1d(tempo)
+            self.products[f'beat_frames:{signal}'] = beat_frames
+        return self.products[f'tempo:{signal}'], self.products[f'beat_frames:{signal}']
+
+
+def estimate_tempo(onset_envelope, sr, hop_length=HOP_LENGTH, ac_size=8.0, chunk_frames=4096):
+    """
+    Global tempo as librosa.feature.tempo computes it for beat_track, but
+    without materialising the whole tempogram.
+    
+    librosa averages a (win_length × frames) tempogram over time, which on
+    a 15-minute track is gigabytes. Tempogram columns are independent, so
+    the time average is accumulated chunk by chunk instead.
+    """
+    win_length = librosa.time_to_frames(ac_size, sr=sr, hop_length=hop_length).item()
+    n = len(onset_envelope)
+    
+    # Same centring as tempogram(center=True); column j then reads padded[j:j + win_length]
+    padded = np.pad(onset_envelope, win_length // 2, mode='linear_ramp', end_values=[0, 0])
+    
+    total = np.zeros(win_length)
+    for start in range(0, n, chunk_frames):
+        stop = min(n, start + chunk_frames)
+        tg = librosa.feature.tempogram(
+            onset_envelope=padded[start:stop + win_length - 1],
+            sr=sr,
+            hop_length=hop_length,
+            win_length=win_length,
+            center=False
+        )
+        total += tg.sum(axis=-1)
+    
+    mean_tg = (total / max(n, 1))[:, np.newaxis]
+    return librosa.feature.tempo(tg=mean_tg, sr=sr, hop_length=hop_length, aggregate=None)
+
+
+# =============================================================================
+# Streaming Analysis
+# AnalysisContext holds full-length signals and spectrograms, so memory
+# grows with track length. StreamingAnalysisContext decodes and analyses
+# the track in overlapping blocks instead: each block is HPSS-split and
+# turned into mel spectrograms, and only its core (the part unaffected by
+# the block edges) is kept. Signals and mel frames go to memory-mapped temp
+# files; onset envelopes and beats are then built from those in bounded
+# chunks. Peak memory depends on the block size, not on the track.
+# =============================================================================
+
+ONSET_LAG = 1
+ONSET_N_FFT = 2048
+# onset_strength output frame f compares spectrogram frames f-4 and f-5
+# (lag plus the centering shift of n_fft // (2 * hop))
+ONSET_HISTORY = ONSET_LAG + ONSET_N_FFT // (2 * HOP_LENGTH)
+# power_to_db's default dynamic range floor
+TOP_DB = 80.0
+
+
+class StreamingAnalysisContext(AnalysisContext):
+    """
+    AnalysisContext for long tracks, built block by block from the file.
+    
+    block_seconds:  core length of each analysis block
+    margin_seconds: context analysed on both sides of a block and thrown
+                    away; must cover the HPSS median filter (~0.35s) and
+                    STFT windows so the kept core matches a whole-track run
+    
+    Everything the beat-aligned and legacy pipelines read is precomputed:
+    the mix and percussive signals (memory-mapped), onset envelopes for
+    both, with mean/median/max aggregation and full or 8 kHz mel range,
+    and the harmonic energy used by hold detection.
+    Any other product falls back to whole-track computation.
+    """
+    
+    MEL_FMAXES = (None, 8000)
+    
+    def __init__(self, audio_path, margin=3.0, block_seconds=30.0, margin_seconds=3.0):
+        # Block edges land on multiples of the HPSS hop so every block's
+        # STFT frames line up with the whole-track frame grid
+        align = HPSS_HOP_LENGTH
+        self.block_samples = max(align, int(block_seconds * SR) // align * align)
+        self.margin_samples = max(align, int(margin_seconds * SR) // align * align)
+        
+        self._workdir = tempfile.TemporaryDirectory(prefix='beatmap_stream_')
+        super().__init__(None, SR, margin=margin)
+        self._analyse(audio_path)
+    
+    def _memmap_path(self, name):
+        return os.path.join(self._workdir.name, name.replace(':', '_') + '.f32')
+    
+    def _decode_blocks(self, audio_path, read_frames=1 << 16):
+        """Yield mono float32 chunks at SR, resampled incrementally."""
+        try:
+            info = sf.info(audio_path)
+        except RuntimeError:
+            # Formats libsndfile can't read still work, just without
+            # bounded decode memory
+            logger.info("  Streaming decode unavailable for this file, decoding whole track")
+            y, _ = load_audio(audio_path, sr=SR)
+            for start in range(0, len(y), read_frames):
+                yield y[start:start + read_frames]
+            return
+        
+        resampler = None
+        if info.samplerate != SR:
+            # Same soxr 'HQ' engine librosa.load uses, fed incrementally
+            resampler = soxr.ResampleStream(info.samplerate, SR, 1, dtype='float32', quality='HQ')
+        
+        for block in sf.blocks(audio_path, blocksize=read_frames, dtype='float32', always_2d=True):
+            mono = block.mean(axis=1)
+            yield resampler.resample_chunk(mono) if resampler else mono
+        if resampler:
+            yield resampler.resample_chunk(np.zeros(0, dtype=np.float32), last=True)
+    
+    def _analysis_blocks(self, audio_path):
+        """
+        Yield (block, block_start, core_start, core_end, is_last) with the
+        block spanning core ± margin samples (clipped at the track edges).
+        """
+        buffer = np.zeros(0, dtype=np.float32)
+        buffer_start = 0
+        core_start = 0
+        B, M = self.block_samples, self.margin_samples
+        
+        chunks = self._decode_blocks(audio_path)
+        exhausted = False
+        while True:
+            # Pull audio until the next block's right margin is available
+            while not exhausted and buffer_start + len(buffer) < core_start + B + M:
+                chunk = next(chunks, None)
+                if chunk is None:
+                    exhausted = True
+                else:
+                    buffer = np.concatenate([buffer, chunk])
+            
+            total = buffer_start + len(buffer)
+            if core_start >= total and not (core_start == 0 and exhausted):
+                break
+            
+            block_start = max(0, core_start - M)
+            block_end = min(total, core_start + B + M)
+            core_end = min(total, core_start + B)
+            is_last = exhausted and core_end >= total
+            
+            yield (buffer[block_start - buffer_start:block_end - buffer_start],
+                   block_start, core_start, core_end, is_last)
+            
+            if is_last:
+                break
+            core_start += B
+            # Drop audio no later block can reach
+            keep_from = core_start - M
+            if keep_from > buffer_start:
+                buffer = buffer[keep_from - buffer_start:]
+                buffer_start = keep_from
+    
+    def _analyse(self, audio_path):
+        logger.info(f"Streaming audio: {audio_path}")
+        signal_files = {name: open(self._memmap_path(name), 'wb') for name in ('mix', 'percussive')}
+        mel_files = {}
+        mel_peaks = {}
+        harmonic_energy = []
+        n_samples = 0
+        n_frames = 0
+        
+        for block, block_start, core_start, core_end, is_last in self._analysis_blocks(audio_path):
+            # HPSS on the whole block; only the core samples are trustworthy
+            stft = librosa.stft(block)
+            stft_harm, stft_perc = librosa.decompose.hpss(stft, margin=self.margin)
+            
+            # Harmonic energy per HPSS frame, kept for the core only
+            hpss_offset = block_start // HPSS_HOP_LENGTH
+            hpss_end = core_end // HPSS_HOP_LENGTH + 1 if is_last else core_end // HPSS_HOP_LENGTH
+            hpss_core = slice(core_start // HPSS_HOP_LENGTH - hpss_offset, hpss_end - hpss_offset)
+            harmonic_energy.append(np.mean(np.abs(stft_harm[:, hpss_core]) ** 2, axis=0))
+            del stft_harm
+            
+            signals = {
+                'mix': block,
+                'percussive': librosa.istft(stft_perc, dtype=block.dtype, length=len(block)),
+            }
+            
+            core = slice(core_start - block_start, core_end - block_start)
+            # Frame f of the block is frame block_start // HOP_LENGTH + f of
+            # the track; the last block also owns the trailing centred frame
+            frame_offset = block_start // HOP_LENGTH
+            frame_end = core_end // HOP_LENGTH + 1 if is_last else core_end // HOP_LENGTH
+            core_frames = slice(core_start // HOP_LENGTH - frame_offset, frame_end - frame_offset)
+            
+            for name, y in signals.items():
+                signal_files[name].write(np.ascontiguousarray(y[core], dtype=np.float32).tobytes())
+                power = np.abs(librosa.stft(y, hop_length=HOP_LENGTH)) ** 2
+                for fmax in self.MEL_FMAXES:
+                    mel = librosa.feature.melspectrogram(
+                        S=power, sr=self.sr, n_mels=128,
+                        fmax=0.5 * self.sr if fmax is None else fmax
+                    )
+                    # dB without the top_db floor; the floor depends on the
+                    # whole-track maximum and is applied once that is known
+                    mel_db = librosa.power_to_db(np.abs(mel[:, core_frames]), top_db=None)
+                    key = f'{name}:{fmax}'
+                    if key not in mel_files:
+                        mel_files[key] = open(self._memmap_path(f'mel_{key}'), 'wb')
+                        mel_peaks[key] = -np.inf
+                    mel_files[key].write(np.ascontiguousarray(mel_db.T, dtype=np.float32).tobytes())
+                    if mel_db.size:
+                        mel_peaks[key] = max(mel_peaks[key], mel_db.max())
+            
+            n_samples = core_end
+            n_frames = frame_end
+        
+        for f in list(signal_files.values()) + list(mel_files.values()):
+            f.close()
+        
+        self.products['harmonic_energy'] = np.concatenate(harmonic_energy)
+        
+        # Full-length signals stay on disk and are paged in on demand
+        for name in signal_files:
+            signal = np.memmap(self._memmap_path(name), dtype=np.float32, mode='r', shape=(n_samples,))
+            if name == 'mix':
+                self.y = signal
+            else:
+                self.products[name] = signal
+        
+        for key in mel_files:
+            mel_db = np.memmap(self._memmap_path(f'mel_{key}'), dtype=np.float32, mode='r',
+                               shape=(n_frames, 128))
+            floor = np.float32(mel_peaks[key]) - TOP_DB
+            name, fmax = key.split(':')
+            envelopes = self._stitched_envelopes(mel_db, floor)
+            for aggregate, env in envelopes.items():
+                self.products[f'onset_env:{name}:{aggregate}:{fmax}'] = env
+    
+    def _stitched_envelopes(self, mel_db, floor, chunk_frames=8192):
+        """
+        onset_strength for every aggregate over a memory-mapped
+        (frames, mels) dB spectrogram, ONSET_HISTORY frames of context per
+        chunk so the stitched result has no seams.
+        """
+        n_frames = mel_db.shape[0]
+        envelopes = {agg: np.zeros(n_frames, dtype=np.float32) for agg in ONSET_AGGREGATES}
+        for start in range(0, n_frames, chunk_frames):
+            context_start = max(0, start - ONSET_HISTORY)
+            stop = min(n_frames, start + chunk_frames)
+            S = np.maximum(np.asarray(mel_db[context_start:stop]).T, floor)
+            for aggregate, fn in ONSET_AGGREGATES.items():
+                env = librosa.onset.onset_strength(
+                    S=S, sr=self.sr, hop_length=HOP_LENGTH,
+                    lag=ONSET_LAG, n_fft=ONSET_N_FFT, aggregate=fn
+                )
+                envelopes[aggregate][start:stop] = env[start - context_start:]
+        return envelopes
+
+
+def detect_bpm(analysis):
     """Estimate the tempo of the track."""
-    tempo, _ = librosa.beat.beat_track(y=y, sr=sr, hop_length=HOP_LENGTH)
-    # librosa returns either a scalar or array depending on version
-    if hasattr(tempo, '__len__'):
-        return float(tempo[0])
-    return float(tempo)
+    tempo, _ = analysis.beats('mix')
+    return float(tempo[0])
 
 
-def get_beat_times(y, sr):
+def get_beat_times(analysis, signal='mix'):
     """Return timestamps for each detected beat."""
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr, hop_length=HOP_LENGTH)
-    beat_times = librosa.frames_to_time(beat_frames, sr=sr, hop_length=HOP_LENGTH)
+    _, beat_frames = analysis.beats(signal)
+    beat_times = librosa.frames_to_time(beat_frames, sr=analysis.sr, hop_length=HOP_LENGTH)
     return beat_times
 
 
@@ -51,6 +599,9 @@ def separate_percussive(y, margin=3.0):
         - 5.0 = very aggressive (only the hardest transients survive)
     
     Using margin=3.0 gives us cleaner kick/snare/hat isolation than the default (1.0).
+    
+    The pipeline itself goes through AnalysisContext, which runs this split
+    once per track; this helper is kept for one-off use.
     """
     y_harmonic, y_percussive = librosa.effects.hpss(y, margin=margin)
     return y_harmonic, y_percussive
@@ -65,6 +616,8 @@ def refine_onset_to_transient(y, sr, onset_time, search_window_ms=15):
     ±1 frame (~11ms) uncertainty from frame-based detection.
     
     Returns the corrected onset time.
+    
+    Single-onset version; the pipeline uses refine_onsets_to_transients.
     """
     search_samples = int(search_window_ms / 1000.0 * sr)
     center_sample = int(onset_time * sr)
@@ -86,7 +639,204 @@ def refine_onset_to_transient(y, sr, onset_time, search_window_ms=15):
     return refined_time
 
 
-def get_onset_times(y, sr, sensitivity='normal'):
+# =============================================================================
+# Persistent Analysis Cache
+# Decoding plus HPSS and beat tracking dominate a run, and none of it
+# depends on difficulty, offset or lane settings. AnalysisCache stores the
+# compact 1-D products of an AnalysisContext (decoded audio, percussive
+# signal, onset envelopes, beat frames, onset times) as one .npz per track,
+# keyed by the audio file's content hash plus the analysis parameters.
+# 2-D spectrograms are cheap to rebuild from the cached signals and far
+# too large to keep, so they are never written.
+# =============================================================================
+
+# Bump when a cached product's meaning changes so stale entries are ignored
+CACHE_FORMAT_VERSION = 1
+
+
+class AnalysisCache:
+    """
+    On-disk store of analysis products with a size cap and LRU eviction.
+    
+    Entries are <cache_dir>/<key>.npz, with the decoded audio beside it
+    as <key>.mix.npy so a hit memory-maps it instead of reading it in.
+    Reading an entry refreshes its mtime, and the least recently used
+    files are deleted once the directory grows past max_bytes.
+    """
+    
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_CACHE_SIZE_MB * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.max_bytes = max_bytes
+    
+    @staticmethod
+    def key_for(audio_path, margin=3.0):
+        """Content hash of the audio file plus every parameter the products depend on."""
+        digest = hashlib.sha256()
+        with open(audio_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                digest.update(chunk)
+        digest.update(
+            f'v{CACHE_FORMAT_VERSION}:sr={SR}:hop={HOP_LENGTH}:margin={margin:g}'.encode()
+        )
+        return digest.hexdigest()
+    
+    def _entry_path(self, key):
+        return self.cache_dir / f'{key}.npz'
+    
+    def _mix_path(self, key):
+        return self.cache_dir / f'{key}.mix.npy'
+    
+    def load(self, key):
+        """Return the cached products for key as a dict, or None on a miss."""
+        path = self._entry_path(key)
+        mix_path = self._mix_path(key)
+        if not path.exists() and not mix_path.exists():
+            return None
+        products = {}
+        try:
+            if path.exists():
+                with np.load(path) as entry:
+                    products = {name: entry[name] for name in entry.files}
+            if mix_path.exists():
+                products['mix'] = np.load(mix_path, mmap_mode='r')
+        except (OSError, ValueError) as e:
+            logger.info(f"  Ignoring unreadable cache entry {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            mix_path.unlink(missing_ok=True)
+            return None
+        # Touch so eviction sees this entry as recently used
+        for touched in (path, mix_path):
+            if touched.exists():
+                os.utime(touched)
+        return products
+    
+    def store(self, analysis):
+        """Persist the 1-D products of a cache-backed context, then enforce the size cap."""
+        if analysis.cache_key is None:
+            return
+        products = {
+            name: value for name, value in analysis.products.items()
+            if isinstance(value, np.ndarray) and value.ndim <= 1
+        }
+        
+        path = self._entry_path(analysis.cache_key)
+        mix_path = self._mix_path(analysis.cache_key)
+        # Entries from before the separate mix file keep it inside the npz
+        has_mix = mix_path.exists()
+        if path.exists():
+            with np.load(path) as entry:
+                has_mix = has_mix or 'mix' in entry.files
+                if has_mix and set(products) <= set(entry.files):
+                    return  # nothing new since this entry was written
+        
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        if not has_mix:
+            self._write_atomic(mix_path, '.npy.tmp', lambda f: np.save(f, np.asarray(analysis.y, dtype=np.float32)))
+        self._write_atomic(path, '.npz.tmp', lambda f: np.savez(f, **products))
+        self.evict()
+    
+    def _write_atomic(self, path, suffix, write):
+        # Write to a temp file first so a crash never leaves a truncated entry
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=suffix)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+    
+    def evict(self):
+        """Delete least recently used entries until the cache fits in max_bytes."""
+        if not self.cache_dir.exists():
+            return
+        # Several build-library workers may share one cache, so entries can
+        # vanish between listing and stat/unlink
+        entries = []
+        for path in [*self.cache_dir.glob('*.npz'), *self.cache_dir.glob('*.mix.npy')]:
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+        total = sum(size for _, size, _ in entries)
+        while entries and total > self.max_bytes:
+            _, size, oldest = entries.pop(0)
+            total -= size
+            oldest.unlink(missing_ok=True)
+    
+    def clear(self):
+        """Remove the whole cache directory."""
+        if self.cache_dir.exists():
+            shutil.rmtree(self.cache_dir)
+
+
+TRANSIENT_ENVELOPES = ['amplitude', 'energy']
+
+
+def transient_envelope(y, sr, kind='amplitude', energy_window_ms=2):
+    """
+    Per-sample envelope that transient refinement searches for its peak.
+    
+    kind:
+        'amplitude' - |y|, the raw waveform peak (original behaviour)
+        'energy'    - y² smoothed over energy_window_ms; less likely to lock
+                      onto a single spiky sample in noisy or clipped audio
+    """
+    if kind == 'energy':
+        width = max(1, int(energy_window_ms / 1000.0 * sr))
+        return np.convolve(np.square(y), np.ones(width) / width, mode='same')
+    return np.abs(y)
+
+
+def refine_onsets_to_transients(envelope, sr, onset_times, search_window_ms=15, envelope_start=0):
+    """
+    Batched refine_onset_to_transient: snap every onset to the envelope
+    peak within ±search_window_ms in one pass.
+    
+    envelope: non-negative per-sample array, see transient_envelope().
+              np.abs(y) reproduces refine_onset_to_transient exactly.
+    envelope_start: track sample index of envelope[0] when refining against
+              a slice; the slice must cover every in-track search window.
+    
+    Windows come from a strided view of one padded copy of the envelope,
+    so there is no per-onset slicing or Python call overhead.
+    """
+    onset_times = np.asarray(onset_times, dtype=float)
+    search_samples = int(search_window_ms / 1000.0 * sr)
+    if len(onset_times) == 0 or search_samples == 0:
+        return onset_times.copy()
+    
+    centers = (onset_times * sr).astype(int) - envelope_start
+    
+    # Pad with -1 so out-of-range samples never win the argmax against a
+    # real (non-negative) envelope value; this reproduces the clipped
+    # [start, end) windows of the per-onset version
+    pad_left = search_samples + max(0, -int(centers.min()))
+    pad_right = search_samples + max(0, int(centers.max()) - len(envelope))
+    padded = np.concatenate([
+        np.full(pad_left, -1.0, dtype=envelope.dtype),
+        envelope,
+        np.full(pad_right, -1.0, dtype=envelope.dtype),
+    ])
+    
+    windows = np.lib.stride_tricks.sliding_window_view(padded, 2 * search_samples)
+    window_starts = centers - search_samples
+    window_values = windows[window_starts + pad_left]
+    peak_offsets = np.argmax(window_values, axis=1)
+    
+    refined = (envelope_start + window_starts + peak_offsets) / sr
+    
+    # Windows entirely outside the signal keep their original time
+    empty = window_values[np.arange(len(centers)), peak_offsets] < 0
+    refined[empty] = onset_times[empty]
+    
+    return refined
+
+
+def get_onset_times(analysis, sensitivity='normal', signal='percussive',
+                    refine_signal=None, refine_envelope='amplitude'):
     """
     Detect note placement by finding audio onsets using high-resolution
     percussive transient detection.
@@ -97,9 +847,26 @@ def get_onset_times(y, sr, sensitivity='normal'):
     - Superflux-style onset detection with lag=2 for sharper peak picking
     - Each onset is refined to the true waveform transient peak
     - Percussive signal weighted at 80% to prioritize drum hits
+    
+    signal: which signal supplies the full-spectrum envelope and the
+        waveform used for transient refinement ('percussive' for the
+        beat-aligned pipeline, 'mix' for legacy detection).
+    refine_signal: signal to refine against instead (e.g. 'percussive'
+        for legacy detection); defaults to signal.
+    refine_envelope: 'amplitude' or 'energy', see transient_envelope().
     """
-    # Separate with stronger margin for cleaner drums
-    y_harmonic, y_percussive = separate_percussive(y, margin=3.0)
+    refine_signal = refine_signal or signal
+    
+    # Detection only depends on these settings, so batch runs over several
+    # difficulties reuse the first result
+    return analysis.cached(
+        f'onset_times:{signal}:{sensitivity}:{refine_signal}:{refine_envelope}',
+        lambda: _detect_onset_times(analysis, sensitivity, signal, refine_signal, refine_envelope)
+    )
+
+
+def _detect_onset_times(analysis, sensitivity, signal, refine_signal, refine_envelope):
+    sr = analysis.sr
     
     # Sensitivity presets - lower delta = more notes detected
     sensitivity_settings = {
@@ -111,22 +878,10 @@ def get_onset_times(y, sr, sensitivity='normal'):
     
     # Percussive onset envelope with higher resolution
     # Using max aggregation instead of median to preserve sharp transients
-    onset_env_perc = librosa.onset.onset_strength(
-        y=y_percussive, 
-        sr=sr,
-        hop_length=HOP_LENGTH,
-        aggregate=np.max  # max preserves sharp drum transients better than median
-    )
+    onset_env_perc = analysis.onset_envelope('percussive', aggregate='max')
     
     # Full-spectrum onset envelope catches melodic accents we'd otherwise miss
-    onset_env_full = librosa.onset.onset_strength(
-        y=y, 
-        sr=sr,
-        hop_length=HOP_LENGTH,
-        feature=librosa.feature.melspectrogram,
-        n_mels=128,
-        fmax=8000
-    )
+    onset_env_full = analysis.onset_envelope(signal, fmax=8000)
     
     # Blend heavily toward percussion — we want drum hits, not chord changes
     onset_env_combined = 0.8 * onset_env_perc + 0.2 * onset_env_full
@@ -147,23 +902,59 @@ def get_onset_times(y, sr, sensitivity='normal'):
     
     # Refine each onset to the exact waveform transient peak
     # This removes the ±1 frame jitter from frame-based detection
-    refined_times = np.array([
-        refine_onset_to_transient(y, sr, t, search_window_ms=12)
-        for t in onset_times
-    ])
+    return refine_onsets_in_blocks(
+        analysis.signal(refine_signal), sr, onset_times,
+        kind=refine_envelope,
+        search_window_ms=12
+    )
+
+
+def refine_onsets_in_blocks(y, sr, onset_times, kind='amplitude', search_window_ms=12, block_seconds=30.0):
+    """
+    refine_onsets_to_transients over bounded slices of y.
     
-    return refined_times
+    Only one block's envelope exists at a time, so refinement against a
+    memory-mapped signal (streaming mode) never pulls the whole track into
+    memory. Each slice carries enough margin for the search windows and the
+    energy smoothing, so the result is identical to one whole-track call.
+    """
+    onset_times = np.asarray(onset_times, dtype=float)
+    refined = onset_times.copy()
+    if len(onset_times) == 0:
+        return refined
+    
+    margin = 2 * int(search_window_ms / 1000.0 * sr) + int(0.01 * sr)
+    block_samples = int(block_seconds * sr)
+    centers = (onset_times * sr).astype(int)
+    
+    # onset_times are sorted, so each block is a contiguous run of onsets
+    block_ids = np.clip(centers, 0, None) // block_samples
+    boundaries = np.flatnonzero(np.diff(block_ids)) + 1
+    for group in np.split(np.arange(len(onset_times)), boundaries):
+        lo = max(0, int(centers[group[0]]) - margin)
+        hi = min(len(y), int(centers[group[-1]]) + margin)
+        if hi <= lo:
+            continue  # past the end of the track; these keep their original times
+        envelope = transient_envelope(np.asarray(y[lo:hi]), sr, kind=kind)
+        refined[group] = refine_onsets_to_transients(
+            envelope, sr, onset_times[group],
+            search_window_ms=search_window_ms,
+            envelope_start=lo
+        )
+    
+    return refined
 
 
-def get_strong_beats(y, sr):
+def get_strong_beats(analysis):
     """
     Extract beats with above-average intensity.
     Good for downbeats and accents.
     """
-    tempo, beat_frames = librosa.beat.beat_track(y=y, sr=sr, units='frames', hop_length=HOP_LENGTH)
+    sr = analysis.sr
+    _, beat_frames = analysis.beats('mix')
     
     # Measure how "loud" each beat is
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=HOP_LENGTH)
+    onset_env = analysis.onset_envelope('mix')
     beat_strengths = onset_env[beat_frames] if len(beat_frames) > 0 else []
     
     # Only keep beats above median strength
@@ -193,21 +984,42 @@ def build_beat_grid(beat_times, subdivision=4):
     if len(beat_times) < 2:
         return np.array(beat_times)
     
-    grid = []
-    for i in range(len(beat_times) - 1):
-        beat_start = beat_times[i]
-        beat_end = beat_times[i + 1]
-        beat_duration = beat_end - beat_start
-        
-        # Create subdivision points within this beat
-        for sub in range(subdivision):
-            grid_time = beat_start + (sub / subdivision) * beat_duration
-            grid.append(grid_time)
+    beat_times = np.asarray(beat_times, dtype=float)
+    beat_starts = beat_times[:-1, np.newaxis]
+    beat_durations = np.diff(beat_times)[:, np.newaxis]
+    
+    # One row of subdivision points per beat, flattened in time order
+    fractions = np.arange(subdivision) / subdivision
+    grid = (beat_starts + fractions * beat_durations).ravel()
     
     # Add the final beat
-    grid.append(beat_times[-1])
+    return np.append(grid, beat_times[-1])
+
+
+def nearest_grid_indices(times, grid_times):
+    """
+    Index of the closest grid point for every time, via binary search.
     
-    return np.array(grid)
+    grid_times must be sorted ascending (build_beat_grid output is).
+    Ties go to the lower index and runs of equal grid values resolve to
+    their first entry, exactly like np.argmin(np.abs(grid_times - t)).
+    O((times + grid) log grid) instead of O(times × grid).
+    """
+    times = np.asarray(times, dtype=float)
+    grid_times = np.asarray(grid_times, dtype=float)
+    
+    right = np.searchsorted(grid_times, times, side='left')
+    right = np.clip(right, 0, len(grid_times) - 1)
+    left = np.clip(right - 1, 0, len(grid_times) - 1)
+    
+    # |a - b| is exact-symmetric in floating point, so these match argmin's distances
+    left_dist = np.abs(grid_times[left] - times)
+    right_dist = np.abs(grid_times[right] - times)
+    closest = np.where(left_dist <= right_dist, left, right)
+    
+    # Duplicate grid values: argmin would return the first copy
+    closest = np.searchsorted(grid_times, grid_times[closest], side='left')
+    return closest
 
 
 def snap_onsets_to_grid(onset_times, grid_times, tolerance_ms=50):
@@ -216,41 +1028,47 @@ def snap_onsets_to_grid(onset_times, grid_times, tolerance_ms=50):
     Returns only onsets that align with the musical grid.
     
     tolerance_ms: max distance (in ms) for an onset to snap to a grid point
+    
+    Each grid point is used at most once: the first onset (in input order)
+    that snaps to a point claims it, and later onsets nearest to that same
+    point are dropped rather than moved to their second-closest point.
     """
+    onset_times = np.asarray(onset_times, dtype=float)
+    if len(onset_times) == 0 or len(grid_times) == 0:
+        return np.array([])
+    
     tolerance_sec = tolerance_ms / 1000.0
-    snapped = []
-    used_grid_points = set()
-    
-    for onset in onset_times:
-        # Find closest grid point
-        distances = np.abs(grid_times - onset)
-        closest_idx = np.argmin(distances)
-        closest_dist = distances[closest_idx]
-        
-        # Only snap if within tolerance and grid point not already used
-        if closest_dist <= tolerance_sec and closest_idx not in used_grid_points:
-            snapped.append(grid_times[closest_idx])
-            used_grid_points.add(closest_idx)
+    grid_times = np.asarray(grid_times, dtype=float)
+    
+    closest_idx = nearest_grid_indices(onset_times, grid_times)
+    closest_dist = np.abs(grid_times[closest_idx] - onset_times)
     
-    return np.array(snapped)
+    # Only snap if within tolerance...
+    in_range = np.flatnonzero(closest_dist <= tolerance_sec)
+    
+    # ...and the grid point is not already used by an earlier onset
+    _, first = np.unique(closest_idx[in_range], return_index=True)
+    winners = in_range[np.sort(first)]
+    
+    return grid_times[closest_idx[winners]]
 
 
-def get_onset_strengths_at_times(y, sr, times):
+def get_onset_strengths_at_times(analysis, times, signal='percussive'):
     """
     Get onset strength values at specific times.
     Uses our global HOP_LENGTH for consistent frame resolution.
     """
-    onset_env = librosa.onset.onset_strength(y=y, sr=sr, hop_length=HOP_LENGTH)
+    onset_env = analysis.onset_envelope(signal)
+    frames = librosa.time_to_frames(np.asarray(times), sr=analysis.sr, hop_length=HOP_LENGTH)
     
-    strengths = []
-    for t in times:
-        frame = librosa.time_to_frames(t, sr=sr, hop_length=HOP_LENGTH)
-        if frame < len(onset_env):
-            strengths.append(onset_env[frame])
-        else:
-            strengths.append(0.0)
+    in_range = frames < len(onset_env)
+    if in_range.all():
+        return onset_env[frames]
     
-    return np.array(strengths)
+    # Times past the end of the envelope read as zero strength
+    strengths = np.zeros(len(frames))
+    strengths[in_range] = onset_env[frames[in_range]]
+    return strengths
 
 
 def classify_hit_strength(strengths):
@@ -258,60 +1076,115 @@ def classify_hit_strength(strengths):
     Classify each onset as soft, medium, or hard based on its
     percussive energy relative to the distribution.
     
-    Returns an array of labels: 'soft', 'medium', 'hard'
+    Returns a uint8 array of HIT_SOFT / HIT_MEDIUM / HIT_HARD codes
+    (HIT_CLASS_NAMES maps them back to 'soft', 'medium', 'hard').
     
     This lets us assign harder notes to more prominent drum hits,
     making the gameplay feel like you're triggering the actual sound.
     """
     if len(strengths) == 0:
-        return np.array([])
+        return np.array([], dtype=np.uint8)
     
+    strengths = np.asarray(strengths)
     p33 = np.percentile(strengths, 33)
     p66 = np.percentile(strengths, 66)
     
-    labels = []
-    for s in strengths:
-        if s >= p66:
-            labels.append('hard')
-        elif s >= p33:
-            labels.append('medium')
-        else:
-            labels.append('soft')
+    classes = np.full(len(strengths), HIT_SOFT, dtype=np.uint8)
+    classes[strengths >= p33] = HIT_MEDIUM
+    classes[strengths >= p66] = HIT_HARD
     
-    return np.array(labels)
+    return classes
+
 
+DENSITY_POLICIES = ['tumbling', 'sliding']
 
-def filter_by_density(times, strengths, max_notes_per_second=4.0):
+
+def filter_by_density(times, strengths, max_notes_per_second=4.0, policy='tumbling'):
     """
     Reduce note density by keeping strongest onsets in each time window.
     Prevents overwhelming the player with too many notes.
+    
+    times must be sorted ascending.
+    
+    policy:
+        'tumbling' - back-to-back windows of 1/max_nps seconds, each starting
+                     at the first note after the previous window; the
+                     strongest note in each window survives. Two survivors
+                     can sit close together either side of a window edge.
+        'sliding'  - survivors are always at least 1/max_nps apart, so
+                     no 1-second window anywhere holds more than max_nps
+                     notes and bursts cannot straddle window edges. Notes
+                     are admitted strongest first, so bursts are thinned
+                     to their loudest hits wherever they fall.
     """
     if len(times) == 0:
         return times
     
+    times = np.asarray(times)
+    strengths = np.asarray(strengths)
+    
     window_size = 1.0 / max_notes_per_second
-    filtered = []
     
+    if policy == 'sliding':
+        return _filter_by_density_sliding(times, strengths, window_size)
+    
+    # For every note, the first note at or past the end of a window starting there
+    window_ends = np.searchsorted(times, times + window_size, side='left')
+    window_ends = np.maximum(window_ends, np.arange(len(times)) + 1)
+    
+    # Each window starts where the previous one ended; walking this chain
+    # is one integer lookup per window rather than per note
+    starts = []
     i = 0
+    ends = window_ends.tolist()
     while i < len(times):
-        window_end = times[i] + window_size
-        
-        # Gather all notes in this window
-        window_notes = []
-        j = i
-        while j < len(times) and times[j] < window_end:
-            window_notes.append((times[j], strengths[j], j))
-            j += 1
-        
-        # Keep the strongest one in this window
-        if window_notes:
-            best = max(window_notes, key=lambda x: x[1])
-            filtered.append(best[0])
-        
-        # Move past this window
-        i = j if j > i else i + 1
+        starts.append(i)
+        i = ends[i]
+    starts = np.array(starts)
+    
+    # Strongest note per window, first one on ties (like max() over a list)
+    window_ids = np.repeat(np.arange(len(starts)), np.diff(np.append(starts, len(times))))
+    window_max = np.maximum.reduceat(strengths, starts)
+    candidates = np.flatnonzero(strengths == window_max[window_ids])
+    _, first = np.unique(window_ids[candidates], return_index=True)
     
-    return np.array(filtered)
+    return times[candidates[first]]
+
+
+def _filter_by_density_sliding(times, strengths, min_gap):
+    """
+    Strongest-first admission: keep a note unless a stronger kept note is
+    less than min_gap away.
+    
+    Worked out in rounds of array operations rather than note by note:
+    each round keeps every undecided note that is the strongest undecided
+    one within min_gap (nothing stronger near it can be kept any more) and
+    drops the undecided notes near those. Rounds continue only through
+    chains of ever-stronger notes each within min_gap of the next, so
+    real onsets take a handful.
+    """
+    n = len(times)
+    # Unique ranks, strongest highest; the earlier note wins ties
+    rank = np.empty(n, dtype=np.int64)
+    rank[np.lexsort((-np.arange(n), strengths))] = np.arange(n)
+    
+    # Notes less than min_gap from note i are lo[i]..hi[i]-1 (i included)
+    lo = np.searchsorted(times, times - min_gap, side='right')
+    hi = np.searchsorted(times, times + min_gap, side='left')
+    bounds = np.column_stack([lo, hi]).ravel()
+    
+    keep = np.zeros(n, dtype=bool)
+    undecided = np.ones(n, dtype=bool)
+    while undecided.any():
+        # Strongest undecided rank near each note (-1 past the end)
+        contenders = np.append(np.where(undecided, rank, -1), -1)
+        local_best = np.maximum.reduceat(contenders, bounds)[::2]
+        admitted = undecided & (rank == local_best)
+        keep |= admitted
+        kept_before = np.concatenate([[0], np.cumsum(admitted)])
+        undecided &= kept_before[hi] == kept_before[lo]
+    
+    return times[keep]
 
 
 def compute_global_offset(onset_times, grid_times, max_correction_ms=20):
@@ -326,12 +1199,10 @@ def compute_global_offset(onset_times, grid_times, max_correction_ms=20):
     if len(onset_times) == 0 or len(grid_times) == 0:
         return 0.0
     
-    errors = []
-    for onset in onset_times:
-        distances = grid_times - onset
-        closest_idx = np.argmin(np.abs(distances))
-        error = distances[closest_idx]  # positive = onset is early, negative = late
-        errors.append(error)
+    onset_times = np.asarray(onset_times, dtype=float)
+    grid_times = np.asarray(grid_times, dtype=float)
+    closest_idx = nearest_grid_indices(onset_times, grid_times)
+    errors = grid_times[closest_idx] - onset_times  # positive = onset is early, negative = late
     
     median_error = np.median(errors)
     max_correction = max_correction_ms / 1000.0
@@ -343,7 +1214,181 @@ def compute_global_offset(onset_times, grid_times, max_correction_ms=20):
     return 0.0
 
 
-def generate_beat_aligned_notes(y, sr, difficulty='normal', sensitivity='normal'):
+# Offset calibration works on ~1 ms bins of the raw waveform
+CALIBRATION_BIN_SAMPLES = 22
+# Below this share of agreeing blocks the correlation isn't applied
+CALIBRATION_MIN_CONFIDENCE = 0.5
+
+
+def leading_silence(y, sr, threshold_db=-60.0, chunk_samples=1 << 16):
+    """Seconds before the first sample louder than threshold_db (dBFS)."""
+    threshold = 10 ** (threshold_db / 20)
+    for start in range(0, len(y), chunk_samples):
+        loud = np.flatnonzero(np.abs(y[start:start + chunk_samples]) >= threshold)
+        if len(loud):
+            return (start + loud[0]) / sr
+    return len(y) / sr
+
+
+def raw_onset_envelope(y, sr, bin_samples=CALIBRATION_BIN_SAMPLES, before_ms=10, after_ms=2, chunk_bins=1 << 16):
+    """
+    Energy jump at each ~1 ms bin, straight from the waveform.
+    
+    Much finer than the STFT onset envelopes (11.6 ms hops), so note
+    times can be lined up with it to the millisecond. Each bin scores the
+    rise in dB from the before_ms leading up to it to the after_ms from
+    it on. The short after window makes the score peak right on an
+    attack instead of anywhere the attack is still ahead.
+    Read in chunks, so memory-mapped audio is fine.
+    """
+    n_bins = len(y) // bin_samples
+    energy = np.empty(n_bins)
+    for first in range(0, n_bins, chunk_bins):
+        last = min(first + chunk_bins, n_bins)
+        block = np.asarray(y[first * bin_samples:last * bin_samples], dtype=np.float64)
+        energy[first:last] = np.square(block).reshape(-1, bin_samples).sum(axis=1)
+    
+    bins_per_ms = sr / bin_samples / 1000.0
+    before = max(1, int(round(before_ms * bins_per_ms)))
+    after = max(1, int(round(after_ms * bins_per_ms)))
+    envelope = np.zeros(n_bins)
+    if n_bins > before + after:
+        totals = np.concatenate([[0.0], np.cumsum(energy)])
+        # Mean energy of bins [i, i + after) against bins [i - before, i)
+        starts = np.arange(before, n_bins - after + 1)
+        rise = (np.log10((totals[starts + after] - totals[starts]) / after + 1e-12)
+                - np.log10((totals[starts] - totals[starts - before]) / before + 1e-12))
+        envelope[starts] = 10.0 * rise
+    return np.maximum(envelope, 0.0)
+
+
+def calibrate_offset(analysis, note_times, audio_path=None, max_lag_ms=30, blocks=8, tolerance_ms=5):
+    """
+    Measure the offset that lines a chart up with what the player hears.
+    
+    offsetMs (positive = shift notes later) is the correlation: the lag,
+    within ±max_lag_ms, at which the raw onset envelope best lines up with
+    the note times. Each note's window is scaled to its own peak so loud
+    passages don't outvote quiet ones.
+    
+    Confidence is the share of `blocks` consecutive slices of the chart
+    whose own best lag is within tolerance_ms of the overall one. The
+    correlation is only applied from CALIBRATION_MIN_CONFIDENCE up.
+    
+    Reported but not applied:
+    - primingMs: MP3 encoder/decoder delay our decode drops (see
+      decoder_priming_delay). Whether the Roku player plays it hasn't been
+      measured; if calibrated charts playtest this much late, add it with
+      --offset.
+    - leadingSilenceMs: in both our decode and the player's output.
+    
+    Returns a dict of millisecond values plus 'confidence', as written
+    to the beatmap header.
+    """
+    y, sr = analysis.signal('mix'), analysis.sr
+    bin_seconds = CALIBRATION_BIN_SAMPLES / sr
+    envelope = raw_onset_envelope(y, sr)
+    
+    max_lag = int(round(max_lag_ms / 1000.0 / bin_seconds))
+    lags = np.arange(-max_lag, max_lag + 1)
+    centers = np.round(np.unique(note_times) / bin_seconds).astype(np.int64)
+    centers = centers[(centers >= max_lag) & (centers < len(envelope) - max_lag)]
+    
+    correlation = 0.0
+    confidence = 0.0
+    spread = None
+    if len(centers) >= blocks:
+        windows = envelope[centers[:, None] + lags]
+        windows = windows / np.maximum(windows.max(axis=1, keepdims=True), 1e-9)
+        score = windows.mean(axis=0)
+        best = int(np.argmax(score))
+        # Parabolic interpolation between the neighbouring lags
+        refined = float(best)
+        if 0 < best < len(lags) - 1:
+            left, mid, right = score[best - 1:best + 2]
+            curvature = left - 2 * mid + right
+            if curvature < 0:
+                refined += 0.5 * (left - right) / curvature
+        correlation = (refined - max_lag) * bin_seconds
+    
+        block_lags = np.array([lags[np.argmax(block.mean(axis=0))] for block in np.array_split(windows, blocks)])
+        block_lags = block_lags * bin_seconds
+        confidence = float(np.mean(np.abs(block_lags - correlation) <= tolerance_ms / 1000.0))
+        spread = float(np.median(np.abs(block_lags - correlation)))
+    
+    priming = decoder_priming_delay(audio_path)
+    applied = correlation if confidence >= CALIBRATION_MIN_CONFIDENCE else 0.0
+    return {
+        'offsetMs': round(float(applied) * 1000.0, 1),
+        'primingMs': round(priming * 1000.0, 1),
+        'correlationMs': round(float(correlation) * 1000.0, 1),
+        'correlationApplied': bool(applied),
+        'confidence': round(confidence, 2),
+        'blockSpreadMs': round(spread * 1000.0, 1) if spread is not None else None,
+        'leadingSilenceMs': round(float(leading_silence(y, sr)) * 1000.0, 1),
+    }
+
+
+def detect_holds(analysis, times, hit_classes, min_hold=0.3, max_hold=4.0, drop_db=6.0, floor_db=-30.0,
+                 release_gap=0.1):
+    """
+    Turn notes that set off sustained harmonic energy into hold notes.
+    
+    Holds start on medium and hard hits. A hold lasts while the harmonic
+    energy after its note stays within drop_db of its level at the note
+    and above floor_db (relative to the track peak), for at most max_hold
+    seconds, and ends release_gap before the next medium or hard hit. Soft
+    notes inside a hold are absorbed into it; holds shorter than min_hold
+    stay taps.
+    
+    The energy comes from the HPSS split the pipeline already ran, and the
+    run length after every note is measured at once on a strided view of
+    the envelope.
+    
+    Returns (times, hit_classes, durations) without the absorbed notes;
+    durations are seconds, 0 for taps.
+    """
+    times = np.asarray(times, dtype=float)
+    hit_classes = np.asarray(hit_classes)
+    n = len(times)
+    if n == 0:
+        return times, hit_classes, np.zeros(0)
+    
+    energy_db = librosa.power_to_db(analysis.harmonic_energy(), ref=np.max)
+    frames = np.clip(
+        librosa.time_to_frames(times, sr=analysis.sr, hop_length=HPSS_HOP_LENGTH),
+        0, len(energy_db) - 1
+    )
+    
+    # Frames sustained after each note, counted up to the first frame that
+    # drops out (the track end counts as a drop)
+    max_frames = max(1, int(max_hold * analysis.sr / HPSS_HOP_LENGTH))
+    padded = np.concatenate([energy_db, np.full(max_frames, -np.inf)])
+    windows = np.lib.stride_tricks.sliding_window_view(padded, max_frames)[frames]
+    start_db = energy_db[frames]
+    sustained = (windows >= (start_db - drop_db)[:, np.newaxis]) & (windows > floor_db)
+    run_frames = np.where(sustained.all(axis=1), max_frames, np.argmin(sustained, axis=1))
+    sustain = run_frames * HPSS_HOP_LENGTH / analysis.sr
+    
+    # Time of the next medium/hard hit after each note (inf when none)
+    strong = hit_classes >= HIT_MEDIUM
+    next_strong = np.minimum.accumulate(np.where(strong, np.arange(n), n)[::-1])[::-1]
+    next_strong = np.append(next_strong[1:], n)
+    next_strong_time = np.append(times, np.inf)[next_strong]
+    
+    durations = np.minimum(sustain, next_strong_time - times - release_gap)
+    durations = np.where(strong & (durations >= min_hold), np.round(durations, 3), 0.0)
+    
+    # A soft note is absorbed when it falls inside an earlier note's hold
+    hold_ends = np.where(durations > 0, times + durations, -np.inf)
+    covered_until = np.maximum.accumulate(np.concatenate([[-np.inf], hold_ends[:-1]]))
+    keep = strong | (times > covered_until)
+    
+    return times[keep], hit_classes[keep], durations[keep]
+
+
+def generate_beat_aligned_notes(analysis, difficulty='normal', sensitivity='normal', density_policy='tumbling',
+                                transient_envelope='amplitude', profiler=NULL_PROFILER, holds=False):
     """
     Generate note times using beat-aligned grid with onset reinforcement.
     This is the core of the musical note placement system.
@@ -354,6 +1399,13 @@ def generate_beat_aligned_notes(y, sr, difficulty='normal', sensitivity='normal'
     - Onset-to-transient refinement for sample-accurate timing
     - Global offset correction to fix systematic drift
     - Hit strength classification for intensity-aware note placement
+    
+    density_policy: 'tumbling' or 'sliding' (see filter_by_density)
+    transient_envelope: 'amplitude' or 'energy' onset refinement target
+    profiler: StageProfiler to record each stage in (see generate_beatmap)
+    holds: turn notes on sustained harmonic energy into holds (see detect_holds)
+    
+    Returns (times, hit_classes, durations); durations is None without holds.
     """
     # Difficulty controls subdivision depth and density
     # NOTE DENSITY: Increase max_nps values for more notes per second
@@ -388,78 +1440,198 @@ def generate_beat_aligned_notes(y, sr, difficulty='normal', sensitivity='normal'
     
     config = difficulty_config.get(difficulty, difficulty_config['normal'])
     
-    # Separate percussive with stronger margin for cleaner drum isolation
-    y_harmonic, y_percussive = separate_percussive(y, margin=3.0)
-    
     # Get beat times from percussive signal (cleaner beat tracking)
-    print("  Tracking beats from percussive signal...")
-    beat_times = get_beat_times(y_percussive, sr)
-    print(f"  Found {len(beat_times)} beats")
+    # The context separates percussive with stronger margin (3.0) on first use
+    logger.info("  Tracking beats from percussive signal...")
+    with profiler.stage('beat tracking'):
+        beat_times = get_beat_times(analysis, signal='percussive')
+    logger.info(f"  Found {len(beat_times)} beats")
     
     # Build subdivided grid
-    print(f"  Building grid with {config['subdivision']}x subdivision...")
-    grid = build_beat_grid(beat_times, subdivision=config['subdivision'])
-    print(f"  Grid has {len(grid)} slots")
+    logger.info(f"  Building grid with {config['subdivision']}x subdivision...")
+    with profiler.stage('beat grid'):
+        grid = build_beat_grid(beat_times, subdivision=config['subdivision'])
+    logger.info(f"  Grid has {len(grid)} slots")
     
     # Get onsets from percussive signal (already uses refined transient detection)
-    print("  Detecting percussive onsets...")
-    onset_times = get_onset_times(y_percussive, sr, sensitivity=sensitivity)
-    print(f"  Found {len(onset_times)} raw onsets")
+    logger.info("  Detecting percussive onsets...")
+    with profiler.stage('onset detection'):
+        onset_times = get_onset_times(
+            analysis,
+            sensitivity=sensitivity,
+            signal='percussive',
+            refine_envelope=transient_envelope
+        )
+    logger.info(f"  Found {len(onset_times)} raw onsets")
     
     # Compute global offset correction before snapping
     # This fixes systematic timing drift (e.g., onsets consistently early/late)
-    global_offset = compute_global_offset(onset_times, grid, max_correction_ms=20)
+    with profiler.stage('global offset'):
+        global_offset = compute_global_offset(onset_times, grid, max_correction_ms=20)
     if abs(global_offset) > 0.003:
-        print(f"  Applying global timing correction: {global_offset*1000:.1f}ms")
+        logger.info(f"  Applying global timing correction: {global_offset*1000:.1f}ms")
         onset_times = onset_times + global_offset
     
     # Snap onsets to grid
-    print(f"  Snapping onsets to grid (tolerance: {config['snap_tolerance']}ms)...")
-    snapped_onsets = snap_onsets_to_grid(
-        onset_times, grid, 
-        tolerance_ms=config['snap_tolerance']
-    )
-    print(f"  {len(snapped_onsets)} onsets aligned to grid")
-    
-    # Always include strong beats (downbeats feel important)
-    strong_beats = get_strong_beats(y, sr)
-    strong_snapped = snap_onsets_to_grid(strong_beats, grid, tolerance_ms=80)
-    
-    # Merge snapped onsets with strong beats
-    all_note_times = np.unique(np.concatenate([snapped_onsets, strong_snapped]))
-    all_note_times = np.sort(all_note_times)
-    print(f"  Merged to {len(all_note_times)} candidate notes")
+    logger.info(f"  Snapping onsets to grid (tolerance: {config['snap_tolerance']}ms)...")
+    with profiler.stage('snapping'):
+        snapped_onsets = snap_onsets_to_grid(
+            onset_times, grid, 
+            tolerance_ms=config['snap_tolerance']
+        )
+        logger.info(f"  {len(snapped_onsets)} onsets aligned to grid")
+        
+        # Always include strong beats (downbeats feel important)
+        strong_beats = get_strong_beats(analysis)
+        strong_snapped = snap_onsets_to_grid(strong_beats, grid, tolerance_ms=80)
+        
+        # Merge snapped onsets with strong beats
+        all_note_times = np.unique(np.concatenate([snapped_onsets, strong_snapped]))
+        all_note_times = np.sort(all_note_times)
+    logger.info(f"  Merged to {len(all_note_times)} candidate notes")
     
     # Get onset strengths for density filtering (using percussive signal for accuracy)
-    strengths = get_onset_strengths_at_times(y_percussive, sr, all_note_times)
+    with profiler.stage('hit strengths'):
+        strengths = get_onset_strengths_at_times(analysis, all_note_times)
     
     # Classify hit strengths for intensity-aware note placement
     hit_classes = classify_hit_strength(strengths)
     
     # Filter by density to keep charts playable
-    print(f"  Filtering to max {config['max_nps']} notes/sec...")
-    final_times = filter_by_density(all_note_times, strengths, config['max_nps'])
-    print(f"  Final note count: {len(final_times)}")
+    logger.info(f"  Filtering to max {config['max_nps']} notes/sec...")
+    with profiler.stage('density filtering'):
+        final_times = filter_by_density(
+            all_note_times, strengths, config['max_nps'],
+            policy=density_policy
+        )
+    logger.info(f"  Final note count: {len(final_times)}")
     
     # Get final strength classifications for the surviving notes
-    final_strengths = get_onset_strengths_at_times(y_percussive, sr, final_times)
-    final_hit_classes = classify_hit_strength(final_strengths)
-    
-    return final_times, final_hit_classes
+    with profiler.stage('hit strengths'):
+        final_strengths = get_onset_strengths_at_times(analysis, final_times)
+        final_hit_classes = classify_hit_strength(final_strengths)
+    
+    durations = None
+    if holds:
+        logger.info("  Detecting hold notes from sustained harmonic energy...")
+        note_count = len(final_times)
+        with profiler.stage('hold detection'):
+            final_times, final_hit_classes, durations = detect_holds(analysis, final_times, final_hit_classes)
+        logger.info(f"  {np.count_nonzero(durations)} holds, {note_count - len(final_times)} taps absorbed")
+    
+    return final_times, final_hit_classes, durations
 
 
-def assign_lanes(times, difficulty='normal', hit_classes=None):
+@functools.lru_cache(maxsize=None)
+def lane_patterns(lane_count=4):
+    """
+    Pattern table for assign_lanes: one row per pattern, 2 * lane_count
+    steps each; note i uses row i % len(table). Built once per lane count.
+    For 4 lanes this is the original hand-written set.
     """
-    Map note times to lanes (0-3).
+    lanes = list(range(lane_count))
+    half = (lane_count + 1) // 2
+    
+    # Centre pair first, then outwards; an odd centre lane pairs with itself
+    pairs = [((lane_count - 1) // 2 - k, lane_count // 2 + k) for k in range(half)]
+    center_edge = []
+    for low, high in pairs:
+        center_edge += [low, high] * 2 if low != high else [low, low]
+    
+    # Outermost pair first, then inwards, then back out
+    outside_in = [lane for pair in reversed(pairs) for lane in dict.fromkeys(pair)]
+    
+    # Alternate between the low and high half of the lanes
+    zigzag = [lane for k in range(half) for lane in (k, k + half) if lane < lane_count]
+    
+    table = np.array([
+        lanes + lanes[::-1],             # sweep
+        zigzag * 2,                      # zigzag
+        lanes * 2,                       # stairs
+        center_edge,                     # center-edge
+        outside_in + outside_in[::-1],   # outside-in
+    ])
+    table.setflags(write=False)
+    return table
+
+
+def _space_notes(times, min_gap):
+    """
+    Indices of the notes kept when each note must be at least min_gap
+    after the previous kept one (greedy, from the start).
+    """
+    times = np.asarray(times, dtype=float)
+    n = len(times)
+    index = np.arange(n)
+    
+    # Where the walk goes after keeping note i: the first note min_gap later
+    following = np.maximum(np.searchsorted(times, times + min_gap, side='left'), index + 1)
+    # times + min_gap can round either way, so settle the last ulp against
+    # the `gap >= min_gap` test the spacing is defined by
+    while True:
+        ahead = np.minimum(following, n - 1)
+        too_close = (following < n) & (times[ahead] - times < min_gap)
+        behind = following - 1
+        far_enough = (behind > index) & (times[behind] - times >= min_gap)
+        if not (too_close.any() or far_enough.any()):
+            break
+        following = following + too_close - far_enough
+    
+    # Only following the chain is sequential
+    following = following.tolist()
+    kept = []
+    i = 0
+    while i < n:
+        kept.append(i)
+        i = following[i]
+    return np.array(kept, dtype=np.int64)
+
+
+def assign_lanes(times, difficulty='normal', hit_classes=None, seed=None, lane_count=4, durations=None):
+    """
+    Map note times to lanes as a list of {'time', 'lane'} dicts (plus
+    'duration' on holds). See assign_lanes_array for the arguments.
+    """
+    return notes_as_dicts(assign_lanes_array(times, difficulty, hit_classes, seed, lane_count, durations))
+
+
+def notes_as_dicts(notes):
+    """
+    NOTE_DTYPE records as the per-note dicts beatmap JSON is written from.
+    Times and durations are rounded to the millisecond; hit classes are
+    not part of the file format.
+    """
+    notes_out = [
+        {'time': round(time, 3), 'lane': lane}
+        for time, lane in zip(notes['time'].tolist(), notes['lane'].tolist())
+    ]
+    for i in np.flatnonzero(notes['duration'] > 0).tolist():
+        notes_out[i]['duration'] = round(float(notes['duration'][i]), 3)
+    return notes_out
+
+
+def assign_lanes_array(times, difficulty='normal', hit_classes=None, seed=None, lane_count=4, durations=None):
+    """
+    Map note times to lanes (0 to lane_count - 1).
     Higher difficulties = more notes, more doubles.
+    Returns a NOTE_DTYPE array sorted by (time, lane).
     
-    hit_classes: optional array of 'soft'/'medium'/'hard' labels.
+    hit_classes: optional array of HIT_SOFT/HIT_MEDIUM/HIT_HARD codes.
         - Hard hits get more double-notes (feels like a powerful strike)
         - Soft hits avoid doubles (feels like a light tap)
         This makes the note patterns feel connected to the music's dynamics.
+    seed: seed (or numpy Generator) for every random choice, so the same
+        notes and seed always give the same chart. None draws fresh entropy.
+    lane_count: one of LANE_COUNTS; patterns come from lane_patterns().
+    durations: optional hold length per note (see detect_holds). Doubles
+        are taps.
+    
+    All random numbers are drawn up front as arrays and lanes are worked
+    out with array operations; only the min-gap spacing walks the notes,
+    so the cost per note does not depend on the lane count.
     """
-    notes = []
-    lane_count = 4
+    patterns = lane_patterns(lane_count)
+    rng = np.random.default_rng(seed)
     
     # Tweak these to adjust how each difficulty feels
     # SHIFTED: Easy = old Normal, Normal = near Expert, Hard = almost Expert
@@ -488,65 +1660,60 @@ def assign_lanes(times, difficulty='normal', hit_classes=None):
     
     settings = difficulty_settings.get(difficulty, difficulty_settings['normal'])
     
-    last_time = -1
-    last_lane = -1
-    pattern_counter = 0
-    
-    for i, time in enumerate(times):
-        # Enforce minimum spacing between notes
-        if time - last_time < settings['min_gap']:
-            continue
-        
-        pattern_counter = (pattern_counter + 1) % 8
-        
-        if np.random.random() < settings['pattern_variety']:
-            patterns = [
-                [0, 1, 2, 3, 3, 2, 1, 0],  # sweep
-                [0, 2, 1, 3, 0, 2, 1, 3],  # zigzag
-                [0, 1, 2, 3, 0, 1, 2, 3],  # stairs
-                [1, 2, 1, 2, 0, 3, 0, 3],  # center-edge
-                [0, 3, 1, 2, 2, 1, 3, 0],  # outside-in
-            ]
-            pattern = patterns[i % len(patterns)]
-            lane = pattern[pattern_counter]
-        else:
-            # Random but avoid repeating same lane
-            available_lanes = [l for l in range(lane_count) if l != last_lane]
-            lane = np.random.choice(available_lanes)
-        
-        notes.append({
-            'time': round(float(time), 3),
-            'lane': int(lane)
-        })
-        
-        # Double-note chance is modulated by hit strength:
-        # Hard hits = higher chance (feels like a powerful strike)
-        # Soft hits = lower chance (feels like a light tap)
-        base_chance = settings['double_chance']
-        if hit_classes is not None and i < len(hit_classes):
-            hit_class = hit_classes[i]
-            if hit_class == 'hard':
-                double_chance = min(base_chance * 1.8, 0.6)  # boost for hard hits
-            elif hit_class == 'soft':
-                double_chance = base_chance * 0.3  # reduce for soft hits
-            else:
-                double_chance = base_chance
-        else:
-            double_chance = base_chance
-        
-        if np.random.random() < double_chance:
-            other_lanes = [l for l in range(lane_count) if l != lane]
-            double_lane = np.random.choice(other_lanes)
-            notes.append({
-                'time': round(float(time), 3),
-                'lane': int(double_lane)
-            })
-        
-        last_time = time
-        last_lane = lane
-    
-    notes.sort(key=lambda x: (x['time'], x['lane']))
-    
+    times = np.asarray(times, dtype=float)
+    kept = _space_notes(times, settings['min_gap'])
+    n = len(kept)
+    if n == 0:
+        return np.zeros(0, dtype=NOTE_DTYPE)
+    
+    # Pattern notes step through row (note index % patterns) of the table
+    use_pattern = rng.random(n) < settings['pattern_variety']
+    pattern_lanes = patterns[kept % len(patterns), np.arange(1, n + 1) % patterns.shape[1]]
+    
+    # Random notes avoid repeating the previous lane: stepping 1..lane_count-1
+    # lanes on from it is uniform over the other lanes. Within a run of random
+    # notes the lanes are the run's anchor (the pattern note before it) plus a
+    # running sum of steps; a run at the very start anchors on a random lane.
+    steps = np.where(use_pattern, 0, rng.integers(1, lane_count, n))
+    step_totals = np.cumsum(steps)
+    anchors = np.maximum.accumulate(np.where(use_pattern, np.arange(n), -1))
+    first_lane = rng.integers(lane_count)
+    anchor_lanes = np.where(anchors >= 0, pattern_lanes[np.maximum(anchors, 0)], first_lane)
+    anchor_totals = np.where(anchors >= 0, step_totals[np.maximum(anchors, 0)], 0)
+    random_lanes = (anchor_lanes + step_totals - anchor_totals) % lane_count
+    lanes = np.where(use_pattern, pattern_lanes, random_lanes)
+    
+    # Double-note chance is modulated by hit strength:
+    # Hard hits = higher chance (feels like a powerful strike)
+    # Soft hits = lower chance (feels like a light tap)
+    base_chance = settings['double_chance']
+    double_chance = np.full(n, base_chance)
+    # Unclassified notes (legacy mode) are recorded as medium hits
+    note_classes = np.full(n, HIT_MEDIUM, dtype=np.uint8)
+    if hit_classes is not None:
+        hit_classes = np.asarray(hit_classes)
+        classified = kept < len(hit_classes)
+        note_classes[classified] = hit_classes[kept[classified]]
+        double_chance[classified] = np.select(
+            [note_classes[classified] == HIT_HARD, note_classes[classified] == HIT_SOFT],
+            [min(base_chance * 1.8, 0.6), base_chance * 0.3],  # boost hard, reduce soft
+            base_chance
+        )
+    
+    is_double = rng.random(n) < double_chance
+    double_lanes = (lanes + rng.integers(1, lane_count, n)) % lane_count
+    
+    note_times = np.round(np.concatenate([times[kept], times[kept][is_double]]), 3)
+    note_lanes = np.concatenate([lanes, double_lanes[is_double]])
+    order = np.lexsort((note_lanes, note_times))
+    
+    notes = np.zeros(len(order), dtype=NOTE_DTYPE)
+    notes['time'] = note_times[order]
+    notes['lane'] = note_lanes[order]
+    notes['hit_class'] = np.concatenate([note_classes, note_classes[is_double]])[order]
+    if durations is not None:
+        note_durations = np.concatenate([np.asarray(durations, dtype=float)[kept], np.zeros(is_double.sum())])
+        notes['duration'] = np.round(note_durations[order], 3)
     return notes
 
 
@@ -554,95 +1721,650 @@ def get_audio_duration(y, sr):
     return len(y) / sr
 
 
-def get_difficulty_rating(difficulty):
-    """Star rating for UI display. Randomly selects from the difficulty's star range."""
-    # Easy: 1-2, Normal: 3-4, Hard: 5-6, Expert: 7
-    rating_ranges = {
-        'easy': [1, 2],
-        'normal': [3, 4],
-        'hard': [5, 6],
-        'expert': [7]
-    }
-    stars = rating_ranges.get(difficulty, [3, 4])
-    return int(np.random.choice(stars))
+# difficultyScore at 1 and 7 stars: sparse easy charts score about 2,
+# the densest expert charts about 8
+STAR_SCORE_RANGE = (2.0, 8.0)
 
 
-def generate_beatmap(audio_path, difficulty='normal', bpm_override=None, offset=0, sensitivity='normal', use_beat_aligned=True):
+def get_difficulty_rating(difficulty_score):
     """
-    Analyze audio and generate a playable beatmap.
+    Star rating (1-7) for UI display: the chart's difficultyScore (see
+    chart_stats) scaled linearly onto the star scale. Charts are rated by
+    their notes, not their label, so a dense Normal chart can outrate a
+    sparse Hard one.
+    """
+    lo, hi = STAR_SCORE_RANGE
+    return int(np.clip(round(1 + 6 * (difficulty_score - lo) / (hi - lo)), 1, 7))
+
+
+# WAVE format tags _wav_memmap can map directly, with the sample type
+WAV_FORMAT_PCM = 1
+WAV_FORMAT_FLOAT = 3
+WAV_FORMAT_EXTENSIBLE = 0xFFFE
+
+
+def _wav_memmap(audio_path):
+    """
+    Memory-map the samples of a 16-bit PCM or 32-bit float WAV file.
     
-    use_beat_aligned: if True, uses musical grid snapping (recommended).
-                      if False, uses legacy onset-based detection.
+    Returns (frames x channels memmap, sample rate), or None for anything
+    else (other sample widths, compressed WAV, not a WAV at all), which
+    load_audio then decodes with soundfile.
     """
-    print(f"Loading audio: {audio_path}")
+    with open(audio_path, 'rb') as f:
+        header = f.read(12)
+        if len(header) < 12 or header[:4] != b'RIFF' or header[8:12] != b'WAVE':
+            return None
+        fmt = None
+        while True:
+            chunk = f.read(8)
+            if len(chunk) < 8:
+                return None
+            chunk_id, size = chunk[:4], struct.unpack('<I', chunk[4:])[0]
+            if chunk_id == b'fmt ':
+                body = f.read(size + (size & 1))
+                tag, channels, rate = struct.unpack('<HHI', body[:8])
+                bits = struct.unpack('<H', body[14:16])[0]
+                if tag == WAV_FORMAT_EXTENSIBLE and len(body) >= 26:
+                    tag = struct.unpack('<H', body[24:26])[0]
+                fmt = (tag, channels, rate, bits)
+            elif chunk_id == b'data':
+                data_offset = f.tell()
+                break
+            else:
+                f.seek(size + (size & 1), os.SEEK_CUR)
+    
+    if fmt is None:
+        return None
+    tag, channels, rate, bits = fmt
+    dtypes = {(WAV_FORMAT_PCM, 16): np.dtype('<i2'), (WAV_FORMAT_FLOAT, 32): np.dtype('<f4')}
+    dtype = dtypes.get((tag, bits))
+    if dtype is None or channels == 0:
+        return None
+    # A streamed WAV may leave the data size unset, so trust the file length
+    frames = (os.path.getsize(audio_path) - data_offset) // (dtype.itemsize * channels)
+    if size and size != 0xFFFFFFFF:
+        frames = min(frames, size // (dtype.itemsize * channels))
+    return np.memmap(audio_path, dtype=dtype, mode='r', offset=data_offset, shape=(frames, channels)), rate
+
+
+# Samples an MP3 decoder outputs before the first encoded sample (mpg123,
+# LAME convention); the LAME header's encoder delay comes on top
+MP3_DECODER_DELAY = 529
+MP3_FRAME_SAMPLES = 1152
+
+
+def mp3_priming(audio_path):
+    """
+    Gapless info from an MP3's Xing/Info + LAME header, without decoding.
+    
+    Returns (priming_samples, frame_count, sample_rate): priming is the
+    encoder delay plus MP3_DECODER_DELAY, the samples a gapless decoder
+    drops from the start. None for other files and MP3s without the header.
+    """
+    with open(audio_path, 'rb') as f:
+        data = f.read(1 << 16)
+    
+    start = 0
+    if data[:3] == b'ID3' and len(data) >= 10:
+        # Syncsafe tag size, 7 bits per byte
+        start = 10 + ((data[6] << 21) | (data[7] << 14) | (data[8] << 7) | data[9])
+    if len(data) < start + 4 or data[start] != 0xFF or data[start + 1] & 0xE0 != 0xE0:
+        return None
+    
+    # MPEG-1 / MPEG-2 / MPEG-2.5 sample rates by header bits
+    version = (data[start + 1] >> 3) & 0x3
+    rate_index = (data[start + 2] >> 2) & 0x3
+    if version == 1 or rate_index == 3:
+        return None
+    rate = [44100, 48000, 32000][rate_index] // {3: 1, 2: 2, 0: 4}[version]
+    
+    # The Xing/Info tag sits after the side info in the first frame
+    tag = max(data.find(b'Xing', start, start + 64), data.find(b'Info', start, start + 64))
+    if tag < 0:
+        return None
+    flags = struct.unpack('>I', data[tag + 4:tag + 8])[0]
+    if not flags & 0x1:
+        return None
+    frame_count = struct.unpack('>I', data[tag + 8:tag + 12])[0]
+    lame = tag + 12 + (4 if flags & 0x2 else 0) + (100 if flags & 0x4 else 0) + (4 if flags & 0x8 else 0)
+    # 12-bit encoder delay and padding, 21 bytes into the LAME extension
+    if len(data) < lame + 24:
+        return None
+    delay = (data[lame + 21] << 4) | (data[lame + 22] >> 4)
+    return delay + MP3_DECODER_DELAY, frame_count, rate
+
+
+def decoder_priming_delay(audio_path):
+    """
+    Seconds of MP3 priming our decode drops. A player that plays the
+    priming instead starts the music this much later than our decode.
+    """
+    priming = mp3_priming(audio_path) if audio_path else None
+    if priming is None:
+        return 0.0
+    samples, frame_count, rate = priming
+    try:
+        # A decode shorter than every frame means the priming was trimmed
+        trimmed = sf.info(audio_path).frames < frame_count * MP3_FRAME_SAMPLES
+    except RuntimeError:
+        # librosa's fallback decoder (ffmpeg) honours the header too
+        trimmed = True
+    return samples / rate if trimmed else 0.0
+
+
+def load_audio(audio_path, sr=SR, offset=0.0, duration=None):
+    """
+    Decode audio to mono float32 at sr, taking the cheapest route the file allows.
+    
+    - .npy files are decoded copies already at sr (like the cache's
+      <key>.mix.npy) and are memory-mapped.
+    - 16-bit PCM and float WAV files are memory-mapped; a mono float WAV at
+      sr comes back as the mapping itself, with no copy at all.
+    - Everything libsndfile reads (WAV, FLAC, OGG, MP3) is decoded by
+      soundfile, seeking straight to offset.
+    - Anything else falls back to librosa.load (audioread).
+    
+    Resampling is skipped when the file is already at sr; otherwise it
+    uses the same soxr engine as librosa.load, so the samples match what
+    librosa.load(audio_path, sr=sr) returns.
+    
+    offset/duration: decode only this range, in seconds (e.g. to chart a
+    preview excerpt without decoding the whole song).
+    """
+    suffix = Path(audio_path).suffix.lower()
+    mapped = None
+    if suffix == '.npy':
+        mapped = np.load(audio_path, mmap_mode='r'), sr
+    elif suffix in ('.wav', '.wave'):
+        mapped = _wav_memmap(audio_path)
+    
+    if mapped is not None:
+        samples, native_sr = mapped
+        start = int(round(offset * native_sr))
+        stop = None if duration is None else start + int(round(duration * native_sr))
+        samples = samples[start:stop]
+        if samples.dtype == np.int16:
+            # soundfile's scaling for 16-bit PCM
+            samples = samples.astype(np.float32) / np.float32(0x8000)
+        if samples.ndim > 1:
+            samples = samples.mean(axis=1, dtype=np.float32) if samples.shape[1] > 1 else samples[:, 0]
+        y = samples
+    else:
+        try:
+            with sf.SoundFile(audio_path) as f:
+                native_sr = f.samplerate
+                start = int(round(offset * native_sr))
+                frames = -1 if duration is None else int(round(duration * native_sr))
+                f.seek(start)
+                y = f.read(frames=frames, dtype='float32', always_2d=True).mean(axis=1, dtype=np.float32)
+        except sf.LibsndfileError:
+            y, native_sr = librosa.load(audio_path, sr=None, offset=offset, duration=duration)
+    
+    if native_sr != sr:
+        y = librosa.resample(np.asarray(y), orig_sr=native_sr, target_sr=sr, res_type='soxr_hq')
+    return y, sr
+
+
+def load_analysis(audio_path, cache=None, margin=3.0, streaming=False, block_seconds=30.0,
+                  profiler=NULL_PROFILER, start=0.0, duration=None):
+    """
+    Decode an audio file and wrap it in an AnalysisContext.
+    
+    cache: optional AnalysisCache. On a hit the decode is skipped and the
+           context starts out with every product stored for this file.
+    streaming: analyse in block_seconds blocks with bounded memory
+           (StreamingAnalysisContext). The cache is not used in this mode
+           since its entries hold full-length signals in memory.
+    profiler: records the decode as a 'decode' stage and is kept on the
+           context, so lazily computed stages (HPSS) are recorded too.
+    start/duration: analyse only this range of the file, in seconds (see
+           load_audio). Times in the analysis are relative to start. The
+           cache is not used for ranges and streaming doesn't support them.
+    """
+    with profiler.stage('decode'):
+        analysis = _load_analysis(audio_path, cache, margin, streaming, block_seconds, start, duration)
+    analysis.profiler = profiler
+    analysis.audio_path = audio_path
+    return analysis
+
+
+def _load_analysis(audio_path, cache, margin, streaming, block_seconds, start=0.0, duration=None):
+    excerpt = start or duration is not None
+    if streaming:
+        if excerpt:
+            raise ValueError("streaming analysis reads whole files; start/duration are not supported")
+        return StreamingAnalysisContext(audio_path, margin=margin, block_seconds=block_seconds)
+    
+    if excerpt:
+        logger.info(f"Loading audio: {audio_path} (from {start:g}s"
+                    + (f", {duration:g}s)" if duration is not None else ")"))
+        y, sr = load_audio(audio_path, sr=SR, offset=start, duration=duration)
+        return AnalysisContext(y, sr, margin=margin)
+    
+    key = None
+    if cache is not None:
+        key = cache.key_for(audio_path, margin=margin)
+        cached = cache.load(key)
+        if cached is not None and 'mix' in cached:
+            logger.info(f"Loading cached analysis: {audio_path}")
+            analysis = AnalysisContext(cached.pop('mix'), SR, margin=margin)
+            analysis.products.update(cached)
+            analysis.cache_key = key
+            return analysis
+    
+    logger.info(f"Loading audio: {audio_path}")
     
     # 22050 Hz is plenty for beat detection
-    y, sr = librosa.load(audio_path, sr=22050)
+    y, sr = load_audio(audio_path, sr=SR)
+    analysis = AnalysisContext(y, sr, margin=margin)
+    analysis.cache_key = key
+    return analysis
+
+
+@dataclasses.dataclass
+class BeatmapConfig:
+    """
+    Chart settings for generate_notes / generate_chart.
+    
+    Fields match the generate_beatmap keyword arguments of the same names.
+    """
+    difficulty: str = 'normal'
+    bpm_override: Optional[float] = None
+    offset: float = 0
+    sensitivity: str = 'normal'
+    use_beat_aligned: bool = True
+    density_policy: str = 'tumbling'
+    transient_envelope: str = 'amplitude'
+    refine_signal: Optional[str] = None
+    seed: Optional[int] = None
+    lane_count: int = 4
+    holds: bool = False
+    calibrate: bool = False
+
+
+def generate_notes(analysis, config=None, profiler=NULL_PROFILER):
+    """
+    Chart an analysed track without any file or JSON work.
+    
+    Returns (notes, info): notes is a NOTE_DTYPE array sorted by (time,
+    lane); info holds 'bpm' (as detected or overridden), 'duration' in
+    seconds, 'stats' (see chart_stats), the 'offset' applied to the notes
+    and, with config.calibrate, the 'calibration' (see calibrate_offset).
+    """
+    config = config or BeatmapConfig()
+    difficulty = config.difficulty
+    y, sr = analysis.y, analysis.sr
     
     duration = get_audio_duration(y, sr)
-    print(f"Duration: {duration:.2f} seconds")
+    logger.info(f"Duration: {duration:.2f} seconds")
     
-    if bpm_override:
-        bpm = bpm_override
-        print(f"Using manual BPM: {bpm}")
+    if config.bpm_override:
+        bpm = config.bpm_override
+        logger.info(f"Using manual BPM: {bpm}")
     else:
-        bpm = detect_bpm(y, sr)
-        print(f"Detected BPM: {bpm:.1f}")
+        with profiler.stage('bpm detection'):
+            bpm = detect_bpm(analysis)
+        logger.info(f"Detected BPM: {bpm:.1f}")
     
-    if use_beat_aligned:
+    if config.use_beat_aligned:
         # New beat-aligned system - notes snap to musical grid
-        print(f"\nUsing beat-aligned generation (difficulty: {difficulty})...")
-        note_times, hit_classes = generate_beat_aligned_notes(y, sr, difficulty=difficulty, sensitivity=sensitivity)
+        logger.info(f"\nUsing beat-aligned generation (difficulty: {difficulty})...")
+        note_times, hit_classes, durations = generate_beat_aligned_notes(
+            analysis,
+            difficulty=difficulty,
+            sensitivity=config.sensitivity,
+            density_policy=config.density_policy,
+            transient_envelope=config.transient_envelope,
+            profiler=profiler,
+            holds=config.holds
+        )
     else:
         # Legacy behavior - raw onset detection
-        print(f"Analyzing audio for note placement (sensitivity: {sensitivity})...")
-        onset_times = get_onset_times(y, sr, sensitivity=sensitivity)
-        print(f"Found {len(onset_times)} potential note positions")
+        logger.info(f"Analyzing audio for note placement (sensitivity: {config.sensitivity})...")
+        with profiler.stage('onset detection'):
+            onset_times = get_onset_times(
+                analysis,
+                sensitivity=config.sensitivity,
+                signal='mix',
+                refine_signal=config.refine_signal,
+                refine_envelope=config.transient_envelope
+            )
+        logger.info(f"Found {len(onset_times)} potential note positions")
         
         # Include strong beats so we don't miss obvious downbeats
-        strong_beats = get_strong_beats(y, sr)
-        print(f"Found {len(strong_beats)} strong beats")
+        with profiler.stage('strong beats'):
+            strong_beats = get_strong_beats(analysis)
+        logger.info(f"Found {len(strong_beats)} strong beats")
         
         # Merge and dedupe
         note_times = np.unique(np.concatenate([onset_times, strong_beats]))
         note_times = np.sort(note_times)
-        print(f"Combined to {len(note_times)} unique note positions")
+        logger.info(f"Combined to {len(note_times)} unique note positions")
         hit_classes = None
-    
-    print(f"\nGenerating {difficulty} beatmap...")
-    notes = assign_lanes(note_times, difficulty, hit_classes=hit_classes)
+        durations = None
+    
+    logger.info(f"\nGenerating {difficulty} beatmap...")
+    with profiler.stage('lane assignment'):
+        notes = assign_lanes_array(note_times, difficulty, hit_classes=hit_classes, seed=config.seed,
+                                   lane_count=config.lane_count, durations=durations)
+    
+    offset = config.offset
+    calibration = None
+    if config.calibrate:
+        with profiler.stage('offset calibration'):
+            calibration = calibrate_offset(analysis, notes['time'].astype(float), audio_path=analysis.audio_path)
+        logger.info(f"Calibrated offset: {calibration['offsetMs']:+.1f}ms (onset correlation "
+                    f"{calibration['correlationMs']:+.1f}ms at {calibration['confidence']:.0%} confidence"
+                    + ("" if calibration['correlationApplied'] else ", not applied")
+                    + f"; decoder priming {calibration['primingMs']:.1f}ms not applied)")
+        offset = round(offset + calibration['offsetMs'] / 1000.0, 3)
     
     # Apply timing offset if specified
     if offset != 0:
-        print(f"Applying offset of {offset}s to all notes...")
-        for note in notes:
-            note['time'] = round(note['time'] + offset, 3)
+        logger.info(f"Applying offset of {offset}s to all notes...")
+        shifted = np.round(np.round(notes['time'].astype(float), 3) + offset, 3)
+        notes['time'] = shifted
         # Drop any notes that would be before t=0
-        notes = [n for n in notes if n['time'] >= 0]
+        notes = notes[shifted >= 0]
     
-    print(f"Generated {len(notes)} notes")
+    logger.info(f"Generated {len(notes)} notes")
     
-    audio_filename = Path(audio_path).stem
+    stats = chart_stats(
+        np.round(notes['time'].astype(float), 3),
+        notes['lane'],
+        duration,
+        lane_count=config.lane_count
+    )
+    info = {'bpm': bpm, 'duration': duration, 'stats': stats, 'offset': offset}
+    if calibration is not None:
+        info['calibration'] = calibration
+    return notes, info
+
+
+def generate_chart(y, sr, config=None, profiler=NULL_PROFILER):
+    """
+    generate_notes for a waveform already in memory; nothing is decoded.
     
+    y: float samples, mono or (channels, samples) like librosa.load returns
+       with mono=False. Other rates are resampled to SR, which every
+       analysis window is tuned for.
+    Returns (notes, info) as generate_notes does.
+    """
+    y = np.asarray(y, dtype=np.float32)
+    if y.ndim > 1:
+        y = y.mean(axis=0)
+    if sr != SR:
+        with profiler.stage('resample'):
+            # Same soxr 'HQ' engine librosa.load uses
+            y = soxr.resample(y, sr, SR, quality='HQ')
+    analysis = AnalysisContext(y, SR)
+    analysis.profiler = profiler
+    return generate_notes(analysis, config, profiler=profiler)
+
+
+# How long GameplayScene keeps a note on screen, independent of resolution:
+# it spawns above the screen and falls to the hit line at 86% of the height
+# at 0.7 heights/s, and is auto-missed 20% of a height past it
+NOTE_TRAVEL_SECONDS = (0.86 + 0.046) / 0.7
+NOTE_MISS_SECONDS = 0.20 / 0.7
+
+
+def peak_on_screen(notes, lane_count=4):
+    """
+    Most notes each lane can have on screen at once.
+    
+    Assumes the worst case, that nothing is hit early: a note is shown from
+    NOTE_TRAVEL_SECONDS before its time until it is auto-missed, or until
+    its hold ends if that is later. The client sizes its per-lane pool of
+    note nodes from these counts.
+    """
+    times = notes['time'].astype(float)
+    shown = times - NOTE_TRAVEL_SECONDS
+    hidden = times + np.maximum(notes['duration'].astype(float), NOTE_MISS_SECONDS)
+    
+    peaks = []
+    for lane in range(lane_count):
+        in_lane = notes['lane'] == lane
+        starts = np.sort(shown[in_lane])
+        ends = np.sort(hidden[in_lane])
+        # At each note's spawn: notes spawned so far minus those already gone
+        on_screen = np.arange(1, len(starts) + 1) - np.searchsorted(ends, starts, side='right')
+        peaks.append(int(on_screen.max(initial=0)))
+    return peaks
+
+
+def beatmap_from_notes(notes, info, config=None, title='Untitled', artist='Unknown Artist'):
+    """The beatmap JSON dict for generate_notes output; the only place notes become dicts."""
+    config = config or BeatmapConfig()
     beatmap = {
-        "title": audio_filename.replace('_', ' ').title(),
-        "artist": "Unknown Artist",
-        "difficulty": difficulty.capitalize(),
-        "difficultyRating": get_difficulty_rating(difficulty),
-        "bpm": round(bpm),
-        "offset": offset,
-        "length": int(duration),
+        "title": title,
+        "artist": artist,
+        "difficulty": config.difficulty.capitalize(),
+        "difficultyRating": get_difficulty_rating(info['stats']['difficultyScore']),
+        "bpm": round(info['bpm']),
+        "offset": info.get('offset', config.offset),
+        "length": int(info['duration']),
+        "laneCount": config.lane_count,
         "noteCount": len(notes),
-        "notes": notes
+        "peakOnScreen": peak_on_screen(notes, config.lane_count),
+        "notes": notes_as_dicts(notes)
     }
+    if config.seed is not None:
+        beatmap["seed"] = config.seed
+    if 'calibration' in info:
+        beatmap["calibration"] = info['calibration']
+    return beatmap
+
+
+def generate_beatmap(audio_path, difficulty='normal', bpm_override=None, offset=0, sensitivity='normal', use_beat_aligned=True, analysis=None, cache=None, density_policy='tumbling',
+                     transient_envelope='amplitude', refine_signal=None, streaming=False, profiler=NULL_PROFILER,
+                     seed=None, lane_count=4, holds=False, start=0.0, duration=None, calibrate=False):
+    """
+    Analyze audio and generate a playable beatmap.
+    
+    use_beat_aligned: if True, uses musical grid snapping (recommended).
+                      if False, uses legacy onset-based detection.
+    analysis: optional AnalysisContext from load_analysis(audio_path).
+              Passing the same context for several difficulties skips
+              the decode and every difficulty-independent analysis step.
+    cache: optional AnalysisCache used when no analysis is passed in.
+    density_policy: 'tumbling' (default) or 'sliding' note density cap,
+                    see filter_by_density.
+    transient_envelope: 'amplitude' (default) or 'energy', the envelope
+                        onsets are refined against (see transient_envelope).
+    refine_signal: legacy mode only - refine onsets against 'percussive'
+                   instead of the full mix.
+    streaming: analyse in bounded-memory blocks (see load_analysis).
+    profiler: StageProfiler that records wall time, CPU time and peak
+              memory per stage; the default NULL_PROFILER records nothing.
+    seed: lane assignment seed (see assign_lanes). With a seed the same
+          audio and settings always produce the same chart; it is recorded
+          in the beatmap header.
+    lane_count: key mode, one of LANE_COUNTS (recorded as laneCount).
+    holds: beat-aligned mode only - emit hold notes with a 'duration'
+           where the harmonic energy sustains (see detect_holds).
+    start/duration: chart only this range of the audio, in seconds, for
+           quick previews; note times are relative to start (see
+           load_analysis).
+    calibrate: measure how the notes line up with the raw onsets and
+           shift the notes by that on top of offset (see calibrate_offset;
+           off by default here, on by default on the command line). The
+           header's offset is the total shift and 'calibration' holds the
+           measurements.
+    
+    For waveforms already in memory use generate_chart and
+    beatmap_from_notes instead.
+    """
+    owns_analysis = analysis is None
+    if owns_analysis:
+        analysis = load_analysis(audio_path, cache=cache, streaming=streaming, profiler=profiler,
+                                 start=start, duration=duration)
+    
+    config = BeatmapConfig(
+        difficulty=difficulty,
+        bpm_override=bpm_override,
+        offset=offset,
+        sensitivity=sensitivity,
+        use_beat_aligned=use_beat_aligned,
+        density_policy=density_policy,
+        transient_envelope=transient_envelope,
+        refine_signal=refine_signal,
+        seed=seed,
+        lane_count=lane_count,
+        holds=holds,
+        calibrate=calibrate
+    )
+    notes, info = generate_notes(analysis, config, profiler=profiler)
+    
+    audio_filename = Path(audio_path).stem
+    beatmap = beatmap_from_notes(notes, info, config, title=audio_filename.replace('_', ' ').title())
+    
+    if owns_analysis and cache is not None:
+        with profiler.stage('cache store'):
+            cache.store(analysis)
     
     return beatmap
 
 
-def save_beatmap(beatmap, output_path):
-    with open(output_path, 'w') as f:
-        json.dump(beatmap, f, indent=2)
-    print(f"Saved beatmap to: {output_path}")
+def generate_beatmaps(audio_path, difficulties, cache=None, streaming=False, profiler=NULL_PROFILER,
+                      start=0.0, duration=None, **kwargs):
+    """
+    Generate one beatmap per difficulty from a single decode.
+    
+    Only grid subdivision, snapping, density filtering and lane assignment
+    run per difficulty; everything else comes from the shared context.
+    Returns a dict of difficulty -> beatmap, in the order given.
+    """
+    analysis = load_analysis(audio_path, cache=cache, streaming=streaming, profiler=profiler,
+                             start=start, duration=duration)
+    beatmaps = {}
+    for difficulty in difficulties:
+        # Per-difficulty stages are grouped under the difficulty's name
+        with profiler.stage(difficulty):
+            beatmaps[difficulty] = generate_beatmap(
+                audio_path,
+                difficulty=difficulty,
+                analysis=analysis,
+                profiler=profiler,
+                **kwargs
+            )
+    if cache is not None:
+        with profiler.stage('cache store'):
+            cache.store(analysis)
+    return beatmaps
+
+
+def compact_beatmap(beatmap):
+    """
+    Columnar form of a beatmap for fast loading on the Roku client.
+    
+    Note times become integer milliseconds in one 'timesMs' array, with
+    lanes in a parallel 'lanes' array, so ParseJson builds two flat arrays
+    instead of one associative array per note. Charts with holds also get
+    a parallel 'durationsMs' array (0 for taps). Metadata is unchanged.
+    """
+    compact = {k: v for k, v in beatmap.items() if k != 'notes'}
+    compact['formatVersion'] = COMPACT_FORMAT_VERSION
+    compact['timesMs'] = [int(round(note['time'] * 1000)) for note in beatmap['notes']]
+    compact['lanes'] = [note['lane'] for note in beatmap['notes']]
+    if any('duration' in note for note in beatmap['notes']):
+        compact['durationsMs'] = [int(round(note.get('duration', 0) * 1000)) for note in beatmap['notes']]
+    return compact
+
+
+def legacy_variant_path(output_path):
+    """Where save_beatmap puts the legacy file next to a compact one."""
+    output_path = Path(output_path)
+    return output_path.with_name(f"{output_path.stem}.legacy{output_path.suffix}")
+
+
+def segment_beatmap(beatmap, output_path, segment_seconds=30.0):
+    """
+    Split a beatmap into fixed-length time segments.
+    
+    Returns (manifest, [(segment_path, segment), ...]). Each segment is a
+    compact chart ('timesMs'/'lanes', plus 'durationsMs' with holds) of
+    the notes starting in [startMs, endMs); empty segments are left out. The manifest keeps the
+    chart metadata (noteCount, length, bpm, ...) and lists every segment's
+    file name (relative to the manifest), time range and note count, so
+    SongSelect can show the chart and the client can start playing after
+    reading only the first segment.
+    """
+    output_path = Path(output_path)
+    segment_ms = int(round(segment_seconds * 1000))
+    compact = compact_beatmap(beatmap)
+    
+    times_ms = compact.pop('timesMs')
+    lanes = compact.pop('lanes')
+    durations_ms = compact.pop('durationsMs', None)
+    
+    groups = {}
+    for i, time_ms in enumerate(times_ms):
+        groups.setdefault(max(time_ms, 0) // segment_ms, []).append(i)
+    
+    manifest = compact
+    manifest['segmentMs'] = segment_ms
+    manifest['segments'] = []
+    segments = []
+    for index in sorted(groups):
+        members = groups[index]
+        name = f"{output_path.stem}.seg{index:03d}{output_path.suffix}"
+        start_ms = index * segment_ms
+        manifest['segments'].append({
+            'path': name,
+            'startMs': start_ms,
+            'endMs': start_ms + segment_ms,
+            'noteCount': len(members),
+        })
+        segment = {
+            'startMs': start_ms,
+            'timesMs': [times_ms[i] for i in members],
+            'lanes': [lanes[i] for i in members],
+        }
+        if durations_ms is not None:
+            segment['durationsMs'] = [durations_ms[i] for i in members]
+        segments.append((output_path.with_name(name), segment))
+    return manifest, segments
+
+
+def save_beatmap(beatmap, output_path, output_format='legacy', segment_seconds=None):
+    """
+    Write a beatmap as JSON. Legacy files keep their indented layout;
+    compact charts and segments are written without whitespace.
+    
+    output_format: 'legacy' - one {"time", "lane"} object per note
+                   'compact' - columnar, see compact_beatmap
+                   'both' - compact at output_path plus a legacy copy at
+                            legacy_variant_path(output_path) for older clients
+    segment_seconds: write the compact chart as a manifest at output_path
+                     plus one file per segment (see segment_beatmap).
+                     Not available with the 'legacy' format.
+    """
+    segments = []
+    if output_format == 'legacy':
+        if segment_seconds:
+            raise ValueError("segmented beatmaps need the 'compact' or 'both' format")
+        files = [(output_path, beatmap)]
+    else:
+        if segment_seconds:
+            manifest, segments = segment_beatmap(beatmap, output_path, segment_seconds)
+            files = [(output_path, manifest)]
+        else:
+            files = [(output_path, compact_beatmap(beatmap))]
+        if output_format == 'both':
+            files.append((legacy_variant_path(output_path), beatmap))
+    
+    for path, data in files + segments:
+        with open(path, 'w') as f:
+            if data is beatmap:
+                json.dump(data, f, indent=2)
+            else:
+                json.dump(data, f, separators=(',', ':'))
+    for path, _ in files:
+        print(f"Saved beatmap to: {path}")
+    if segments:
+        print(f"Saved {len(segments)} segment(s) next to: {output_path}")
 
 
 def print_beatmap_summary(beatmap):
@@ -653,16 +2375,30 @@ def print_beatmap_summary(beatmap):
     print(f"Title: {beatmap['title']}")
     print(f"Difficulty: {beatmap['difficulty']} ({beatmap['difficultyRating']} stars)")
     print(f"BPM: {beatmap['bpm']}")
+    calibration = beatmap.get('calibration')
+    if calibration:
+        print(f"Offset: {beatmap['offset'] * 1000:+.0f}ms (calibrated {calibration['offsetMs']:+.1f}ms, "
+              f"{calibration['confidence']:.0%} confidence; decoder priming "
+              f"{calibration['primingMs']:.0f}ms and leading silence {calibration['leadingSilenceMs']:.0f}ms "
+              f"not applied)")
+    elif beatmap['offset']:
+        print(f"Offset: {beatmap['offset'] * 1000:+.0f}ms")
     print(f"Length: {beatmap['length']} seconds")
     print(f"Notes: {beatmap['noteCount']}")
-    print(f"Notes per second: {beatmap['noteCount'] / beatmap['length']:.2f}")
-    
-    lane_counts = [0, 0, 0, 0]
+    print(f"Notes per second: {beatmap['noteCount'] / max(beatmap['length'], 1):.2f}")
+    hold_count = sum(1 for note in beatmap['notes'] if 'duration' in note)
+    if hold_count:
+        print(f"Holds: {hold_count}")
+    if 'peakOnScreen' in beatmap:
+        print(f"Peak notes on screen per lane: {beatmap['peakOnScreen']}")
+    
+    lane_count = beatmap.get('laneCount', 4)
+    lane_counts = [0] * lane_count
     for note in beatmap['notes']:
         lane_counts[note['lane']] += 1
     
-    print("\nLane Distribution:")
-    lane_names = ['Left (←)', 'Up (↑)', 'Down (↓)', 'Right (→)']
+    print(f"\nLane Distribution ({lane_count}K):")
+    lane_names = LANE_KEY_NAMES[lane_count]
     for i, count in enumerate(lane_counts):
         pct = (count / len(beatmap['notes']) * 100) if beatmap['notes'] else 0
         print(f"  {lane_names[i]}: {count} ({pct:.1f}%)")
@@ -670,7 +2406,420 @@ def print_beatmap_summary(beatmap):
     print("="*50 + "\n")
 
 
+# =============================================================================
+# Chart Statistics
+# Summary numbers computed from a chart's actual notes. generate_beatmap
+# uses them for the star rating, and the song catalog (song_index.json)
+# stores them per song so SongSelect never has to open a beatmap.
+# =============================================================================
+
+CATALOG_HISTOGRAM_BINS = 20
+
+
+def chart_stats(times, lanes, length, lane_count=4, histogram_bins=CATALOG_HISTOGRAM_BINS):
+    """
+    Density, lane and chord statistics for one chart.
+    
+    times: note times in seconds, sorted; lanes: matching lane indices;
+    length: song length in seconds; lane_count: the chart's key mode.
+    
+    peakNps is the most notes in any one-second window. densityHistogram
+    is notes per second over histogram_bins equal slices of the song.
+    chordRatio is the share of notes that land together with another note.
+    difficultyScore blends average density, peak density and chords into
+    one number (see get_difficulty_rating); it depends only on the notes.
+    """
+    # Whole milliseconds, as stored, so chord detection is exact
+    times_ms = np.round(np.asarray(times, dtype=float) * 1000).astype(np.int64)
+    lanes = np.asarray(lanes, dtype=np.int64)
+    n = len(times_ms)
+    length = max(float(length), times_ms[-1] / 1000.0 if n else 0.0, 1e-3)
+    
+    if n:
+        window_ends = np.searchsorted(times_ms, times_ms + 1000, side='left')
+        peak_nps = int((window_ends - np.arange(n)).max())
+        _, chord_sizes = np.unique(times_ms, return_counts=True)
+        chord_ratio = chord_sizes[chord_sizes > 1].sum() / n
+        lane_distribution = np.bincount(lanes, minlength=lane_count) / n
+    else:
+        peak_nps = 0
+        chord_ratio = 0.0
+        lane_distribution = np.zeros(lane_count)
+    
+    counts, _ = np.histogram(times_ms / 1000.0, bins=histogram_bins, range=(0.0, length))
+    average_nps = n / length
+    
+    return {
+        'noteCount': n,
+        'averageNps': round(average_nps, 2),
+        'peakNps': peak_nps,
+        'densityHistogram': [round(c, 2) for c in (counts / (length / histogram_bins)).tolist()],
+        'laneDistribution': [round(f, 3) for f in lane_distribution.tolist()],
+        'chordRatio': round(float(chord_ratio), 3),
+        'difficultyScore': round(0.4 * average_nps + 0.15 * peak_nps + 3.0 * float(chord_ratio), 2),
+    }
+
+
+def chart_content_hash(beatmap_path):
+    """SHA-256 over a beatmap file and, for a segmented chart, its segments."""
+    beatmap_path = Path(beatmap_path)
+    digest = hashlib.sha256()
+    data = beatmap_path.read_bytes()
+    digest.update(data)
+    manifest = json.loads(data)
+    for segment in manifest.get('segments', []) if isinstance(manifest, dict) else []:
+        digest.update((beatmap_path.parent / segment['path']).read_bytes())
+    return digest.hexdigest()
+
+
+# =============================================================================
+# Song Library Builder
+# Regenerates every assets/songs/<id>/beatmap.json that has an audio.mp3
+# next to it, in parallel, and rewrites song_index.json from the results.
+# Each index entry records a buildHash of the audio content plus the
+# generation settings; songs whose hash is unchanged are skipped.
+# =============================================================================
+
+def song_build_hash(audio_path, settings):
+    """Fingerprint of an audio file plus the settings used to chart it."""
+    digest = hashlib.sha256(AnalysisCache.key_for(audio_path).encode())
+    digest.update(json.dumps(settings, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+@contextlib.contextmanager
+def capture_log(stream):
+    """Send the generator's log records to stream (only) while open."""
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter('%(message)s'))
+    logger.addHandler(handler)
+    propagate, logger.propagate = logger.propagate, False
+    try:
+        yield
+    finally:
+        logger.removeHandler(handler)
+        logger.propagate = propagate
+
+
+def _build_library_song(job):
+    """
+    ProcessPoolExecutor worker: chart one song and write its beatmap.json.
+    
+    Worker output is captured so parallel songs don't interleave; it is
+    returned with the result and only shown when something goes wrong.
+    """
+    log = io.StringIO()
+    try:
+        with contextlib.redirect_stdout(log), capture_log(log):
+            cache = None
+            if job['cache_dir']:
+                cache = AnalysisCache(job['cache_dir'], max_bytes=job['cache_bytes'])
+            settings = job['settings']
+            beatmap = generate_beatmap(
+                job['audio_path'],
+                difficulty=settings['difficulty'],
+                offset=settings['offset'],
+                sensitivity=settings['sensitivity'],
+                use_beat_aligned=not settings['legacy'],
+                seed=settings['seed'],
+                calibrate=settings['calibrate'],
+                cache=cache
+            )
+            beatmap['title'] = settings['title']
+            beatmap['artist'] = settings['artist']
+            # Bundled charts only ship to the new client, so no legacy copy
+            save_beatmap(beatmap, job['beatmap_path'], output_format='compact')
+    except Exception as e:
+        return {'id': job['id'], 'error': f'{type(e).__name__}: {e}', 'log': log.getvalue()}
+    
+    return {
+        'id': job['id'],
+        'beatmap': {k: v for k, v in beatmap.items() if k != 'notes'},
+        'log': log.getvalue()
+    }
+
+
+def build_library(songs_dir=SONGS_DIR, workers=None, difficulty='normal', sensitivity='normal',
+                  legacy=False, force=False, cache_dir=DEFAULT_CACHE_DIR,
+                  cache_size_mb=DEFAULT_CACHE_SIZE_MB, seed=0, calibrate=True):
+    """
+    Chart every <songs_dir>/*/audio.mp3 across a process pool and rewrite
+    song_index.json.
+    
+    Title, artist, difficulty and coverPath are kept from an existing index
+    entry, and offset from an existing beatmap.json, so hand-tuned values
+    survive a rebuild. Entries without audio are left untouched.
+    Every song is charted with the same lane seed, so unchanged audio and
+    settings rebuild to an identical beatmap. With calibrate, each chart's
+    offset is measured (see calibrate_offset); a hand-tuned nudge on top
+    of an earlier calibration is kept.
+    Returns the number of songs that failed to build.
+    """
+    songs_dir = Path(songs_dir)
+    index_path = songs_dir / 'song_index.json'
+    index = load_song_index(index_path)
+    entries = {entry['id']: entry for entry in index.get('songs', [])}
+    
+    jobs = []
+    for audio_path in sorted(songs_dir.glob('*/audio.mp3')):
+        song_id = audio_path.parent.name
+        beatmap_path = audio_path.parent / 'beatmap.json'
+        entry = entries.get(song_id, {})
+        
+        offset = 0
+        if beatmap_path.exists():
+            with open(beatmap_path) as f:
+                header = json.load(f)
+            offset = header.get('offset', 0)
+            # Only the hand-tuned part; calibration is measured again
+            if 'calibration' in header:
+                offset = round(offset - header['calibration']['offsetMs'] / 1000.0, 3)
+        
+        settings = {
+            'difficulty': entry.get('difficulty', difficulty).lower(),
+            'sensitivity': sensitivity,
+            'offset': offset,
+            'legacy': legacy,
+            'seed': seed,
+            'calibrate': calibrate,
+            'title': entry.get('title', song_id.replace('_', ' ').title()),
+            'artist': entry.get('artist', 'Unknown Artist'),
+        }
+        build_hash = song_build_hash(audio_path, settings)
+        
+        if not force and beatmap_path.exists() and entry.get('buildHash') == build_hash:
+            print(f"  {song_id}: unchanged, skipping")
+            continue
+        
+        entries.setdefault(song_id, {'id': song_id})['buildHash'] = build_hash
+        jobs.append({
+            'id': song_id,
+            'audio_path': str(audio_path),
+            'beatmap_path': str(beatmap_path),
+            'settings': settings,
+            'cache_dir': cache_dir,
+            'cache_bytes': cache_size_mb * 1024 * 1024,
+        })
+    
+    failures = 0
+    if jobs:
+        workers = workers or os.cpu_count() or 1
+        print(f"Building {len(jobs)} song(s) with {min(workers, len(jobs))} worker(s)...")
+        with ProcessPoolExecutor(max_workers=min(workers, len(jobs))) as pool:
+            futures = [pool.submit(_build_library_song, job) for job in jobs]
+            for future in as_completed(futures):
+                result = future.result()
+                song_id = result['id']
+                entry = entries[song_id]
+                if 'error' in result:
+                    failures += 1
+                    # Leave the hash unset so the next build retries this song
+                    entry.pop('buildHash', None)
+                    print(f"  {song_id}: FAILED ({result['error']})")
+                    print(result['log'])
+                    continue
+                
+                beatmap = result['beatmap']
+                entry.update({
+                    'title': beatmap['title'],
+                    'artist': beatmap['artist'],
+                    'difficulty': beatmap['difficulty'],
+                    'difficultyRating': beatmap['difficultyRating'],
+                    'length': beatmap['length'],
+                    'beatmapPath': f"pkg:/assets/songs/{song_id}/beatmap.json",
+                    'audioPath': f"pkg:/assets/songs/{song_id}/audio.mp3",
+                })
+                entry.setdefault('coverPath', '')
+                print(f"  {song_id}: {beatmap['noteCount']} notes, {beatmap['length']}s")
+    
+    # Rebuilt charts get fresh statistics; so do hand-made ones that changed
+    refreshed = [entry for entry in entries.values() if refresh_catalog_entry(songs_dir, entry)]
+    if not jobs and not refreshed:
+        print("All songs up to date")
+        return 0
+    
+    # Existing order is kept; newly discovered songs go at the end
+    index['songs'] = list(entries.values())
+    save_song_index(index, index_path)
+    
+    return failures
+
+
+def load_song_index(index_path):
+    if Path(index_path).exists():
+        with open(index_path) as f:
+            return json.load(f)
+    return {'version': '1.0', 'songs': []}
+
+
+def save_song_index(index, index_path):
+    with open(index_path, 'w') as f:
+        json.dump(index, f, indent=2)
+        f.write('\n')
+    print(f"Updated song index: {index_path}")
+
+
+def _catalog_beatmap_path(songs_dir, entry):
+    """Local file behind an index entry's pkg:/assets/songs/... beatmapPath."""
+    prefix = 'pkg:/assets/songs/'
+    beatmap_path = entry.get('beatmapPath', '')
+    if beatmap_path.startswith(prefix):
+        return Path(songs_dir) / beatmap_path[len(prefix):]
+    return Path(songs_dir) / entry['id'] / 'beatmap.json'
+
+
+# Fields refresh_catalog_entry derives from a chart
+CATALOG_FIELDS = ('difficultyRating', 'measuredRating', 'expectedAccuracy', 'noteCount', 'laneCount', 'bpm', 'stats')
+
+
+def refresh_catalog_entry(songs_dir, entry, force=False):
+    """
+    Store chart statistics (see chart_stats) on one song_index.json entry.
+    
+    The entry's contentHash records the chart files the statistics came
+    from; when it still matches and every field in CATALOG_FIELDS is
+    present, the chart isn't parsed again. Also sets noteCount, laneCount,
+    bpm and the chart header's difficultyRating (get_difficulty_rating from
+    difficultyScore for headers without one), and plays the chart with
+    gameplay_sim's human model: the mean accuracy is stored as
+    expectedAccuracy and the stars it measures as measuredRating.
+    Returns True if the entry changed.
+    """
+    beatmap_path = _catalog_beatmap_path(songs_dir, entry)
+    if not beatmap_path.exists():
+        return False
+    
+    content_hash = chart_content_hash(beatmap_path)
+    if (not force and entry.get('contentHash') == content_hash
+            and all(field in entry for field in CATALOG_FIELDS)):
+        return False
+    
+    metadata, times, lanes, durations = read_chart(beatmap_path, with_durations=True)
+    stats = chart_stats(times, lanes, metadata.get('length', entry.get('length', 0)),
+                        lane_count=metadata.get('laneCount', 4))
+    accuracy, stars = measured_rating(times, lanes, durations)
+    entry.update({
+        'difficultyRating': metadata.get('difficultyRating', get_difficulty_rating(stats['difficultyScore'])),
+        'measuredRating': stars,
+        'expectedAccuracy': round(accuracy, 2),
+        'noteCount': stats['noteCount'],
+        'laneCount': metadata.get('laneCount', 4),
+        'bpm': metadata.get('bpm', entry.get('bpm', 0)),
+        'stats': stats,
+        'contentHash': content_hash,
+    })
+    return True
+
+
+def build_catalog(songs_dir=SONGS_DIR, force=False):
+    """
+    Refresh chart statistics in song_index.json from the beatmaps on disk,
+    without regenerating anything. Only entries whose chart files changed
+    are re-read. Returns the number of entries updated.
+    """
+    songs_dir = Path(songs_dir)
+    index_path = songs_dir / 'song_index.json'
+    index = load_song_index(index_path)
+    
+    updated = 0
+    for entry in index.get('songs', []):
+        if refresh_catalog_entry(songs_dir, entry, force=force):
+            stats = entry['stats']
+            print(f"  {entry['id']}: {stats['noteCount']} notes, peak {stats['peakNps']} nps, "
+                  f"score {stats['difficultyScore']}, {entry['expectedAccuracy']}% expected accuracy, "
+                  f"{entry['difficultyRating']} stars ({entry['measuredRating']} measured)")
+            updated += 1
+    
+    if updated:
+        save_song_index(index, index_path)
+    else:
+        print("Song catalog up to date")
+    return updated
+
+
+def build_library_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='beatmap_generator.py build-library',
+        description='Regenerate every bundled beatmap and song_index.json in parallel'
+    )
+    parser.add_argument('--songs-dir', default=str(SONGS_DIR),
+                        help='Directory containing <song>/audio.mp3 and song_index.json')
+    parser.add_argument('-j', '--workers', type=int,
+                        help='Worker processes (default: one per CPU core)')
+    parser.add_argument('-d', '--difficulty', choices=DIFFICULTIES, default='normal',
+                        help='Difficulty for songs not yet in the index (default: normal)')
+    parser.add_argument('-s', '--sensitivity', choices=['low', 'normal', 'high'], default='normal',
+                        help='How sensitive beat detection is (default: normal)')
+    parser.add_argument('--legacy', action='store_true',
+                        help='Use legacy onset-based detection instead of beat-aligned grid')
+    parser.add_argument('--force', action='store_true',
+                        help='Rebuild every song even if its audio and settings are unchanged')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='Lane assignment seed (default: 0)')
+    parser.add_argument('--no-calibrate', action='store_true',
+                        help='Keep each chart\'s stored offset instead of measuring it')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'Analysis cache directory (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'Analysis cache size cap in MB (default: {DEFAULT_CACHE_SIZE_MB})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Neither read nor write the analysis cache')
+    args = parser.parse_args(argv)
+    
+    failures = build_library(
+        songs_dir=args.songs_dir,
+        workers=args.workers,
+        difficulty=args.difficulty,
+        sensitivity=args.sensitivity,
+        legacy=args.legacy,
+        force=args.force,
+        seed=args.seed,
+        calibrate=not args.no_calibrate,
+        cache_dir=None if args.no_cache else args.cache_dir,
+        cache_size_mb=args.cache_size
+    )
+    if failures:
+        sys.exit(1)
+
+
+def build_catalog_main(argv):
+    parser = argparse.ArgumentParser(
+        prog='beatmap_generator.py build-catalog',
+        description='Recompute per-chart statistics in song_index.json from existing beatmaps'
+    )
+    parser.add_argument('--songs-dir', default=str(SONGS_DIR),
+                        help='Directory containing song_index.json and the beatmaps it lists')
+    parser.add_argument('--force', action='store_true',
+                        help='Recompute every entry even if its chart files are unchanged')
+    args = parser.parse_args(argv)
+    
+    build_catalog(songs_dir=args.songs_dir, force=args.force)
+
+
+def parse_difficulty_list(value):
+    """argparse type for --difficulties: comma-separated difficulty names."""
+    difficulties = [d.strip().lower() for d in value.split(',') if d.strip()]
+    unknown = [d for d in difficulties if d not in DIFFICULTIES]
+    if unknown or not difficulties:
+        raise argparse.ArgumentTypeError(
+            f"expected a comma-separated list of {', '.join(DIFFICULTIES)} (got '{value}')"
+        )
+    # Keep the user's order but drop duplicates
+    return list(dict.fromkeys(difficulties))
+
+
 def main():
+    # Pipeline progress is logged; on the command line it reads as plain output
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
+    
+    # Subcommands get their own parser so the single-file CLI stays unchanged
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-library':
+        build_library_main(sys.argv[2:])
+        return
+    if len(sys.argv) > 1 and sys.argv[1] == 'build-catalog':
+        build_catalog_main(sys.argv[2:])
+        return
+    
     parser = argparse.ArgumentParser(
         description='Generate beatmaps for Roku Osu-Mania from audio files',
         formatter_class=argparse.RawDescriptionHelpFormatter,
@@ -680,64 +2829,192 @@ Examples:
   %(prog)s song.mp3 -d hard -s high           
   %(prog)s song.mp3 --offset -0.1             
   %(prog)s song.mp3 --offset 0.05 -s high     
+  %(prog)s song.mp3 --difficulties easy,normal,hard,expert -o charts/
+  %(prog)s song.mp3 --profile --profile-json profile.json
+  %(prog)s song.mp3 --segment-seconds 30
+  %(prog)s song.mp3 -d expert -k 7 --seed 1
+  %(prog)s build-library -j 8
+  %(prog)s build-catalog
         '''
     )
-    parser.add_argument('audio_file', help='Path to audio file (mp3, wav, ogg, etc.)')
-    parser.add_argument('-o', '--output', help='Output JSON file path')
+    parser.add_argument('audio_file', nargs='?',
+                        help='Path to audio file (mp3, wav, ogg, etc.)')
+    parser.add_argument('-o', '--output',
+                        help='Output JSON file path (output directory with --difficulties)')
     parser.add_argument('-d', '--difficulty', 
-                        choices=['easy', 'normal', 'hard', 'expert'],
+                        choices=DIFFICULTIES,
                         default='normal',
                         help='Difficulty level (default: normal)')
+    parser.add_argument('--difficulties', type=parse_difficulty_list,
+                        help='Comma-separated difficulties to generate from one decode '
+                             '(e.g. easy,normal,hard,expert); overrides --difficulty')
     parser.add_argument('-s', '--sensitivity',
                         choices=['low', 'normal', 'high'],
                         default='normal',
                         help='How sensitive beat detection is (default: normal)')
     parser.add_argument('-b', '--bpm', type=float, help='Override detected BPM')
     parser.add_argument('--offset', type=float, default=0,
-                        help='Shift notes in time (negative = earlier, positive = later)')
+                        help='Shift notes in time (negative = earlier, positive = later), '
+                             'on top of the calibrated offset')
+    parser.add_argument('--no-calibrate', action='store_true',
+                        help='Don\'t measure the offset (how notes line up with the onsets); '
+                             'only --offset shifts notes')
     parser.add_argument('-t', '--title', help='Song title (default: filename)')
     parser.add_argument('-a', '--artist', help='Artist name (default: Unknown Artist)')
     parser.add_argument('--preview', action='store_true',
                         help='Just show what would be generated without saving')
+    parser.add_argument('--start', type=float, default=0.0, metavar='SECONDS',
+                        help='Chart from this point of the song; only the range is decoded '
+                             '(note times are relative to it)')
+    parser.add_argument('--duration', type=float, metavar='SECONDS',
+                        help='Chart only this many seconds (e.g. a quick --preview excerpt)')
+    parser.add_argument('-k', '--lanes', type=int, choices=LANE_COUNTS, default=4,
+                        help='Key mode: number of lanes in the chart (default: 4)')
+    parser.add_argument('--seed', type=int,
+                        help='Lane assignment seed; the same audio, settings and seed always '
+                             'produce the same chart (default: random)')
+    parser.add_argument('--format', choices=BEATMAP_FORMATS, default='legacy',
+                        help='Beatmap file format: per-note objects, columnar, or columnar plus '
+                             'a <name>.legacy.json copy (default: legacy)')
+    parser.add_argument('--segment-seconds', type=float, metavar='SECONDS',
+                        help='Split the compact chart into SECONDS-long <name>.segNNN.json files '
+                             'listed in a manifest at the output path (e.g. 30)')
     parser.add_argument('--legacy', action='store_true',
                         help='Use legacy onset-based detection instead of beat-aligned grid')
+    parser.add_argument('--holds', action='store_true',
+                        help='Turn notes on sustained harmonic energy into hold notes '
+                             '(beat-aligned mode only)')
+    parser.add_argument('--density-policy', choices=DENSITY_POLICIES, default='tumbling',
+                        help='Note density cap: fixed tumbling windows or a sliding '
+                             'notes-per-second window (default: tumbling)')
+    parser.add_argument('--transient-envelope', choices=TRANSIENT_ENVELOPES, default='amplitude',
+                        help='Envelope onsets are refined against: raw amplitude peak or '
+                             'smoothed energy (default: amplitude)')
+    parser.add_argument('--refine-percussive', action='store_true',
+                        help='With --legacy, refine onsets against the percussive component '
+                             'instead of the full mix')
+    parser.add_argument('--streaming', action='store_true',
+                        help='Analyse in overlapping blocks so memory stays bounded on long '
+                             'tracks (bypasses the analysis cache)')
+    parser.add_argument('--profile', action='store_true',
+                        help='Report wall time, CPU time and peak memory for each pipeline stage')
+    parser.add_argument('--profile-json', metavar='PATH',
+                        help='Also write the --profile report to a JSON file (implies --profile)')
+    parser.add_argument('--cache-dir', default=DEFAULT_CACHE_DIR,
+                        help=f'Analysis cache directory (default: {DEFAULT_CACHE_DIR})')
+    parser.add_argument('--cache-size', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'Analysis cache size cap in MB (default: {DEFAULT_CACHE_SIZE_MB})')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='Neither read nor write the analysis cache')
+    parser.add_argument('--clear-cache', action='store_true',
+                        help='Delete the analysis cache before running (audio_file optional)')
     
     args = parser.parse_args()
     
+    cache = AnalysisCache(args.cache_dir, max_bytes=args.cache_size * 1024 * 1024)
+    if args.clear_cache:
+        cache.clear()
+        print(f"Cleared analysis cache: {args.cache_dir}")
+        if not args.audio_file:
+            return
+    if args.no_cache:
+        cache = None
+    
+    if not args.audio_file:
+        parser.error('audio_file is required')
+    
+    if args.start < 0 or (args.duration is not None and args.duration <= 0):
+        parser.error('--start must be >= 0 and --duration positive')
+    if args.streaming and (args.start or args.duration is not None):
+        parser.error('--start/--duration cannot be combined with --streaming')
+    
+    if args.holds and args.legacy:
+        parser.error('--holds needs the beat-aligned mode (drop --legacy)')
+    
+    if args.segment_seconds is not None:
+        if args.segment_seconds <= 0:
+            parser.error('--segment-seconds must be positive')
+        if args.format == 'legacy':
+            parser.error("--segment-seconds needs --format compact or both")
+    
     if not os.path.exists(args.audio_file):
         print(f"Error: Audio file not found: {args.audio_file}")
         sys.exit(1)
     
-    beatmap = generate_beatmap(
-        args.audio_file,
-        difficulty=args.difficulty,
-        bpm_override=args.bpm,
-        offset=args.offset,
-        sensitivity=args.sensitivity,
-        use_beat_aligned=not args.legacy
-    )
-    
-    # Override metadata if provided
-    if args.title:
-        beatmap['title'] = args.title
-    if args.artist:
-        beatmap['artist'] = args.artist
-    
-    print_beatmap_summary(beatmap)
+    generation_args = {
+        'bpm_override': args.bpm,
+        'offset': args.offset,
+        'sensitivity': args.sensitivity,
+        'use_beat_aligned': not args.legacy,
+        'density_policy': args.density_policy,
+        'transient_envelope': args.transient_envelope,
+        'refine_signal': 'percussive' if args.refine_percussive else None,
+        'seed': args.seed,
+        'lane_count': args.lanes,
+        'holds': args.holds,
+        'calibrate': not args.no_calibrate,
+        'streaming': args.streaming,
+        'start': args.start,
+        'duration': args.duration,
+        'cache': cache,
+    }
     
-    if not args.preview:
-        if args.output:
-            output_path = args.output
+    profiling = args.profile or args.profile_json
+    with (StageProfiler() if profiling else contextlib.nullcontext(NULL_PROFILER)) as profiler:
+        if args.difficulties:
+            beatmaps = generate_beatmaps(args.audio_file, args.difficulties, profiler=profiler,
+                                         **generation_args)
         else:
-            audio_name = Path(args.audio_file).stem
-            output_path = f"{audio_name}_{args.difficulty}_beatmap.json"
+            beatmaps = {
+                args.difficulty: generate_beatmap(
+                    args.audio_file,
+                    difficulty=args.difficulty,
+                    profiler=profiler,
+                    **generation_args
+                )
+            }
+    
+    if profiling:
+        profiler.print_report()
+        if args.profile_json:
+            profiler.save_report(
+                args.profile_json,
+                audio=args.audio_file,
+                difficulties=list(beatmaps),
+                streaming=args.streaming,
+                legacy=args.legacy
+            )
+    
+    audio_name = Path(args.audio_file).stem
+    
+    for difficulty, beatmap in beatmaps.items():
+        # Override metadata if provided
+        if args.title:
+            beatmap['title'] = args.title
+        if args.artist:
+            beatmap['artist'] = args.artist
         
-        save_beatmap(beatmap, output_path)
-    else:
-        print("Preview mode - beatmap not saved")
-        print("\nSample notes (first 10):")
-        for note in beatmap['notes'][:10]:
-            print(f"  Time: {note['time']:.3f}s, Lane: {note['lane']}")
+        print_beatmap_summary(beatmap)
+        
+        if not args.preview:
+            default_name = f"{audio_name}_{difficulty}_beatmap.json"
+            if args.difficulties:
+                # In batch mode --output names a directory
+                output_dir = Path(args.output) if args.output else Path('.')
+                output_dir.mkdir(parents=True, exist_ok=True)
+                output_path = output_dir / default_name
+            elif args.output:
+                output_path = args.output
+            else:
+                output_path = default_name
+            
+            save_beatmap(beatmap, output_path, output_format=args.format,
+                         segment_seconds=args.segment_seconds)
+        else:
+            print("Preview mode - beatmap not saved")
+            print("\nSample notes (first 10):")
+            for note in beatmap['notes'][:10]:
+                print(f"  Time: {note['time']:.3f}s, Lane: {note['lane']}")
 
 
 if __name__ == '__main__':
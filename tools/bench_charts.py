@@ -0,0 +1,252 @@
+#!/usr/bin/env python3
+"""
+Chart regression and benchmark suite over the bundled songs.
+
+Charts every assets/songs/*/audio.mp3 at each difficulty with a fixed
+lane seed, one song per fresh worker process so peak RSS is per song.
+For each chart it records the per-stage profile (wall, CPU, traced peak
+memory), the worker's peak RSS, a fingerprint of the notes, and how the
+note times compare with the checked-in beatmap.json when that chart has
+the same difficulty.
+
+Results are written as JSON. Pass an earlier run as --baseline to compare
+commits: any chart whose fingerprint changed is reported and the run
+exits non-zero, so speedups to HPSS, snapping or density filtering can be
+shown not to move notes.
+
+Usage: python tools/bench_charts.py [-o bench.json] [--baseline old.json]
+"""
+
+import argparse
+import contextlib
+import hashlib
+import io
+import json
+import multiprocessing
+import platform
+import resource
+import subprocess
+import sys
+import time
+from pathlib import Path
+
+import librosa
+import numpy as np
+
+from beatmap_generator import (
+    DIFFICULTIES, SONGS_DIR, AnalysisCache, StageProfiler, generate_beatmaps, read_chart
+)
+
+
+def notes_fingerprint(notes):
+    """SHA-256 over the notes exactly as they would be saved."""
+    return hashlib.sha256(json.dumps(notes, separators=(',', ':'), sort_keys=True).encode()).hexdigest()
+
+
+def compare_times(times, reference_times, tolerance_ms):
+    """
+    Match note times against a reference chart's.
+
+    Chords are compared as one time. A time is matched when the other
+    chart has a time within tolerance_ms of it; offsets are measured from
+    each generated time to its nearest reference time.
+    """
+    times = np.unique(times)
+    reference_times = np.unique(reference_times)
+    tolerance = tolerance_ms / 1000.0
+
+    def nearest_offsets(a, b):
+        if len(b) == 0:
+            return np.full(len(a), np.inf)
+        idx = np.clip(np.searchsorted(b, a), 1, max(len(b) - 1, 1))
+        left = b[idx - 1]
+        right = b[np.minimum(idx, len(b) - 1)]
+        return np.where(np.abs(a - left) <= np.abs(a - right), a - left, a - right)
+
+    offsets = nearest_offsets(times, reference_times)
+    matched = np.abs(offsets) <= tolerance
+    reference_matched = np.abs(nearest_offsets(reference_times, times)) <= tolerance
+    matched_ms = np.abs(offsets[matched]) * 1000.0
+
+    return {
+        'toleranceMs': tolerance_ms,
+        'referenceTimes': int(len(reference_times)),
+        'generatedTimes': int(len(times)),
+        'matched': int(matched.sum()),
+        'added': int((~matched).sum()),
+        'removed': int((~reference_matched).sum()),
+        'meanOffsetMs': round(float(matched_ms.mean()), 3) if len(matched_ms) else None,
+        'maxOffsetMs': round(float(matched_ms.max()), 3) if len(matched_ms) else None,
+    }
+
+
+def bench_song(job):
+    """Worker: chart one song at every difficulty and measure it."""
+    log = io.StringIO()
+    cache = AnalysisCache(job['cache_dir']) if job['cache_dir'] else None
+
+    with contextlib.redirect_stdout(log), StageProfiler() as profiler:
+        start = time.perf_counter()
+        # Uncalibrated, so the fingerprints only move when the notes do
+        beatmaps = generate_beatmaps(
+            job['audio_path'], job['difficulties'], cache=cache, profiler=profiler, seed=job['seed'],
+            calibrate=False
+        )
+        wall_s = time.perf_counter() - start
+
+    reference = None
+    if job['reference_path']:
+        metadata, reference_times, _ = read_chart(job['reference_path'])
+        reference = (metadata.get('difficulty', '').lower(), reference_times)
+
+    # generate_beatmaps groups each difficulty's own stages under its name
+    stages = profiler.stage_report()
+    difficulty_wall = {s['stage']: s['wallSeconds'] for s in stages if s['depth'] == 0}
+
+    charts = []
+    for difficulty, beatmap in beatmaps.items():
+        chart = {
+            'song': job['song'],
+            'difficulty': difficulty,
+            'wallSeconds': difficulty_wall.get(difficulty),
+            'noteCount': beatmap['noteCount'],
+            'bpm': beatmap['bpm'],
+            'difficultyRating': beatmap['difficultyRating'],
+            'fingerprint': notes_fingerprint(beatmap['notes']),
+        }
+        if reference is not None and reference[0] == difficulty:
+            times = np.array([note['time'] for note in beatmap['notes']])
+            chart['reference'] = compare_times(times, reference[1], job['tolerance_ms'])
+        charts.append(chart)
+
+    return {
+        'song': job['song'],
+        'wallSeconds': round(wall_s, 3),
+        # ru_maxrss is kilobytes on Linux, bytes on macOS
+        'peakRssMB': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                           / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1),
+        'stages': stages,
+        'charts': charts,
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=Path(__file__).resolve().parent, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_baseline(results, baseline):
+    """Return (lines, changed) comparing charts and timings with an earlier run."""
+    old_charts = {(c['song'], c['difficulty']): c for s in baseline['songs'] for c in s['charts']}
+    old_songs = {s['song']: s for s in baseline['songs']}
+    lines = [f"\nBaseline: {baseline.get('commit') or 'unknown commit'}"]
+    changed = []
+
+    for song in results['songs']:
+        old = old_songs.get(song['song'])
+        if old is not None:
+            lines.append(f"  {song['song']:<20} wall {old['wallSeconds']:>7.2f}s -> {song['wallSeconds']:>7.2f}s "
+                         f"({song['wallSeconds'] / old['wallSeconds']:.2f}x)   "
+                         f"RSS {old['peakRssMB']:>6.0f} -> {song['peakRssMB']:>6.0f} MB")
+        for chart in song['charts']:
+            key = (chart['song'], chart['difficulty'])
+            if key in old_charts and old_charts[key]['fingerprint'] != chart['fingerprint']:
+                changed.append(f"  {key[0]}/{key[1]}: notes changed "
+                               f"({old_charts[key]['noteCount']} -> {chart['noteCount']} notes)")
+
+    lines.append("  charts identical to baseline" if not changed else "\n".join(changed))
+    return lines, changed
+
+
+def print_results(results):
+    print(f"\n{'song':<20}{'difficulty':<12}{'notes':>7}{'wall (s)':>10}{'RSS (MB)':>10}"
+          f"  reference match")
+    for song in results['songs']:
+        print(f"{song['song']:<20}{'(all)':<12}{'':>7}{song['wallSeconds']:>10.2f}{song['peakRssMB']:>10.0f}")
+        for chart in song['charts']:
+            match = ''
+            if 'reference' in chart:
+                ref = chart['reference']
+                match = (f"{ref['matched']}/{ref['generatedTimes']} within {ref['toleranceMs']:g}ms, "
+                         f"+{ref['added']} -{ref['removed']}, mean {ref['meanOffsetMs']}ms")
+            print(f"{'':<20}{chart['difficulty']:<12}{chart['noteCount']:>7}"
+                  f"{chart['wallSeconds']:>10.2f}{'':>10}  {match}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Chart every bundled song and compare with a baseline')
+    parser.add_argument('--songs-dir', default=SONGS_DIR, type=Path,
+                        help='Folder of <song>/audio.mp3 (default: assets/songs)')
+    parser.add_argument('--songs', help='Comma-separated song folders to run (default: all with audio)')
+    parser.add_argument('--difficulties', default=','.join(DIFFICULTIES),
+                        help='Comma-separated difficulties (default: all)')
+    parser.add_argument('--seed', type=int, default=0, help='Lane assignment seed (default: 0)')
+    parser.add_argument('--tolerance-ms', type=float, default=5.0,
+                        help='Reference match tolerance in ms (default: 5)')
+    parser.add_argument('--cache-dir',
+                        help='Use this analysis cache (default: none, so decode and HPSS are timed)')
+    parser.add_argument('-o', '--output', help='Write results as JSON')
+    parser.add_argument('--baseline', help='Earlier results JSON to compare against')
+    args = parser.parse_args()
+
+    difficulties = [d.strip() for d in args.difficulties.split(',') if d.strip()]
+    unknown = [d for d in difficulties if d not in DIFFICULTIES]
+    if unknown:
+        parser.error(f"unknown difficulties: {', '.join(unknown)}")
+
+    song_dirs = sorted(p.parent for p in args.songs_dir.glob('*/audio.mp3'))
+    if args.songs:
+        wanted = {s.strip() for s in args.songs.split(',')}
+        song_dirs = [d for d in song_dirs if d.name in wanted]
+    if not song_dirs:
+        parser.error(f"no songs with audio.mp3 in {args.songs_dir}")
+
+    jobs = [{
+        'song': song_dir.name,
+        'audio_path': str(song_dir / 'audio.mp3'),
+        'reference_path': str(song_dir / 'beatmap.json') if (song_dir / 'beatmap.json').exists() else None,
+        'difficulties': difficulties,
+        'seed': args.seed,
+        'tolerance_ms': args.tolerance_ms,
+        'cache_dir': args.cache_dir,
+    } for song_dir in song_dirs]
+
+    results = {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'librosa': librosa.__version__,
+        'seed': args.seed,
+        'difficulties': difficulties,
+        'songs': [],
+    }
+
+    # One song per fresh process: ru_maxrss never goes down, so reusing a
+    # worker would report the largest song so far
+    for job in jobs:
+        print(f"Charting {job['song']}...")
+        with multiprocessing.Pool(processes=1, maxtasksperchild=1) as pool:
+            results['songs'].append(pool.apply(bench_song, (job,)))
+
+    print_results(results)
+
+    changed = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            lines, changed = compare_baseline(results, json.load(f))
+        print("\n".join(lines))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+        print(f"\nSaved results to: {args.output}")
+
+    if changed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
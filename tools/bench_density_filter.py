@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for the sliding note density cap.
+
+Builds a synthetic candidate set over a long track with dense bursts
+scattered through it, checks that filter_by_density(policy='sliding')
+in beatmap_generator.py keeps exactly what a note-by-note strongest-first
+loop keeps, and reports the speedup. Each burst packs many candidates
+into a few tens of milliseconds; the cap must thin it to its strongest
+note, and no 1-second window anywhere may hold more than max_nps notes.
+
+Usage: python tools/bench_density_filter.py [--minutes 10] [--nps 32] [--max-nps 16]
+"""
+
+import argparse
+import bisect
+import sys
+import time
+
+import numpy as np
+
+from beatmap_generator import filter_by_density
+
+
+def filter_sliding_reference(times, strengths, max_notes_per_second):
+    """Strongest-first admission one note at a time, kept as the oracle."""
+    min_gap = 1.0 / max_notes_per_second
+    kept_times = []
+    kept_idx = []
+    for idx in np.lexsort((np.arange(len(times)), -strengths)).tolist():
+        t = times[idx]
+        pos = bisect.bisect_left(kept_times, t)
+        if (pos == 0 or t - kept_times[pos - 1] >= min_gap) and \
+                (pos == len(kept_times) or kept_times[pos] - t >= min_gap):
+            kept_times.insert(pos, t)
+            kept_idx.insert(pos, idx)
+    return times[np.array(kept_idx, dtype=int)]
+
+
+def synthetic_candidates(minutes, nps, bursts, burst_notes, burst_ms, rng):
+    """Sorted candidate times and strengths, plus each burst's (start, end)."""
+    duration = minutes * 60.0
+    times = [rng.uniform(0, duration, int(duration * nps))]
+    spans = []
+    for start in np.sort(rng.uniform(1.0, duration - 1.0, bursts)):
+        end = start + burst_ms / 1000.0
+        times.append(rng.uniform(start, end, burst_notes))
+        spans.append((start, end))
+    times = np.round(np.sort(np.concatenate(times)), 3)
+    return times, np.round(rng.random(len(times)), 3), spans
+
+
+def check_density(kept, times, strengths, spans, max_notes_per_second):
+    """Return a list of broken invariants (empty when the cap holds)."""
+    problems = []
+    window_ends = np.searchsorted(kept, kept + 1.0, side='left')
+    if len(kept) and (window_ends - np.arange(len(kept))).max() > max_notes_per_second:
+        problems.append('a 1-second window holds more than max_nps notes')
+
+    min_gap = 1.0 / max_notes_per_second
+    for start, end in spans:
+        inside = kept[(kept >= start) & (kept <= end)]
+        if len(inside) > 1:
+            problems.append(f'burst at {start:.3f}s kept {len(inside)} notes')
+            break
+        # With nothing as strong within min_gap of it, the burst's
+        # strongest note must survive
+        in_burst = (times >= start) & (times <= end)
+        near = (times >= start - min_gap) & (times <= end + min_gap) & ~in_burst
+        if strengths[near].max(initial=-1.0) < strengths[in_burst].max() and len(inside) == 0:
+            problems.append(f'burst at {start:.3f}s lost its strongest note')
+            break
+    return problems
+
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the sliding density cap against a per-note loop')
+    parser.add_argument('--minutes', type=float, default=10.0, help='Synthetic track length (default: 10)')
+    parser.add_argument('--nps', type=float, default=32.0, help='Candidate notes per second (default: 32)')
+    parser.add_argument('--max-nps', type=float, default=16.0, help='Density cap, notes/s (default: 16)')
+    parser.add_argument('--bursts', type=int, default=200, help='Dense bursts to scatter (default: 200)')
+    parser.add_argument('--burst-notes', type=int, default=16, help='Candidates per burst (default: 16)')
+    parser.add_argument('--burst-ms', type=float, default=50.0, help='Length of each burst (default: 50)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repeats, best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='RNG seed (default: 0)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    times, strengths, spans = synthetic_candidates(args.minutes, args.nps, args.bursts, args.burst_notes,
+                                                   args.burst_ms, rng)
+    print(f"Candidate notes: {len(times)} ({args.bursts} bursts of {args.burst_notes} in {args.burst_ms:g}ms)")
+
+    ref_time, reference = best_of(lambda: filter_sliding_reference(times, strengths, args.max_nps), 1)
+    fast_time, kept = best_of(lambda: filter_by_density(times, strengths, args.max_nps, policy='sliding'),
+                              args.repeat)
+    tumbling_time, _ = best_of(lambda: filter_by_density(times, strengths, args.max_nps), args.repeat)
+
+    problems = check_density(kept, times, strengths, spans, args.max_nps)
+    if not np.array_equal(kept, reference):
+        problems.append('vectorized output differs from the reference implementation')
+
+    print(f"\n{'policy':<16}{'original':>12}{'vectorized':>12}{'speedup':>10}{'kept':>8}  sound")
+    print(f"{'sliding':<16}{ref_time * 1000:>10.1f}ms{fast_time * 1000:>10.2f}ms"
+          f"{ref_time / fast_time:>9.0f}x{len(kept):>8}  {'yes' if not problems else 'NO'}")
+    print(f"{'tumbling':<16}{'':>12}{tumbling_time * 1000:>10.2f}ms")
+
+    if problems:
+        print("\n" + "\n".join(problems))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark for lane assignment.
+
+Builds a dense synthetic note set, runs the seeded, array-based
+assign_lanes_array in beatmap_generator.py against the original per-note
+loop on the global RNG, and reports the speedup. Turning the notes into
+per-note dicts only happens when a beatmap is written, so that
+(notes_as_dicts) is timed on its own. The two draw random numbers
+differently, so charts are compared on what must hold for both: the
+notes kept by min-gap spacing, no random lane repeating the previous
+one, doubles on a different lane, and the same chart for the same seed.
+Spacing doesn't depend on the key mode, so --lanes compares wider modes
+against the same 4-lane reference.
+
+Usage: python tools/bench_lane_assignment.py [--minutes 10] [--nps 16]
+"""
+
+import argparse
+import sys
+import time
+
+import numpy as np
+
+from beatmap_generator import HIT_HARD, HIT_SOFT, LANE_COUNTS, assign_lanes_array, lane_patterns, notes_as_dicts
+
+
+def assign_lanes_reference(times, difficulty='expert', hit_classes=None):
+    """The original per-note loop, kept as the oracle for spacing."""
+    notes = []
+    lane_count = 4
+    settings = {
+        'easy': {'min_gap': 0.25, 'double_chance': 0.15, 'pattern_variety': 0.5},
+        'normal': {'min_gap': 0.12, 'double_chance': 0.35, 'pattern_variety': 0.85},
+        'hard': {'min_gap': 0.11, 'double_chance': 0.38, 'pattern_variety': 0.88},
+        'expert': {'min_gap': 0.1, 'double_chance': 0.4, 'pattern_variety': 0.9},
+    }[difficulty]
+
+    last_time = -1
+    last_lane = -1
+    pattern_counter = 0
+
+    for i, t in enumerate(times):
+        if t - last_time < settings['min_gap']:
+            continue
+
+        pattern_counter = (pattern_counter + 1) % 8
+
+        if np.random.random() < settings['pattern_variety']:
+            patterns = [
+                [0, 1, 2, 3, 3, 2, 1, 0],
+                [0, 2, 1, 3, 0, 2, 1, 3],
+                [0, 1, 2, 3, 0, 1, 2, 3],
+                [1, 2, 1, 2, 0, 3, 0, 3],
+                [0, 3, 1, 2, 2, 1, 3, 0],
+            ]
+            lane = patterns[i % len(patterns)][pattern_counter]
+        else:
+            available_lanes = [l for l in range(lane_count) if l != last_lane]
+            lane = np.random.choice(available_lanes)
+
+        notes.append({'time': round(float(t), 3), 'lane': int(lane)})
+
+        base_chance = settings['double_chance']
+        if hit_classes is not None and i < len(hit_classes):
+            hit_class = hit_classes[i]
+            if hit_class == HIT_HARD:
+                double_chance = min(base_chance * 1.8, 0.6)
+            elif hit_class == HIT_SOFT:
+                double_chance = base_chance * 0.3
+            else:
+                double_chance = base_chance
+        else:
+            double_chance = base_chance
+
+        if np.random.random() < double_chance:
+            other_lanes = [l for l in range(lane_count) if l != lane]
+            notes.append({'time': round(float(t), 3), 'lane': int(np.random.choice(other_lanes))})
+
+        last_time = t
+        last_lane = lane
+
+    notes.sort(key=lambda x: (x['time'], x['lane']))
+    return notes
+
+
+def check_chart(notes, reference, times, lane_count):
+    """
+    Return a list of broken invariants (empty when the chart is sound).
+
+    notes is assign_lanes_array's output; times are the candidate note
+    times it was given.
+    """
+    problems = []
+    # Millisecond times, as written to the beatmap
+    note_times = np.round(notes['time'].astype(float), 3)
+    note_lanes = notes['lane'].astype(np.int64)
+
+    if not np.array_equal(np.unique(note_times), np.unique([n['time'] for n in reference])):
+        problems.append('kept note times differ from the reference spacing')
+
+    # Chords are a primary note plus one double on a different lane
+    unique_times, counts = np.unique(note_times, return_counts=True)
+    if counts.max(initial=1) > 2:
+        problems.append('more than one double on a note')
+    chord_starts = np.searchsorted(note_times, unique_times[counts == 2])
+    if np.any(note_lanes[chord_starts] == note_lanes[chord_starts + 1]):
+        problems.append('double on the same lane as its note')
+
+    # Random notes never repeat the previous note's lane; pattern notes may,
+    # so a repeat is only sound on the lane the pattern table gives that
+    # note. A chord's primary lane isn't recorded, so only back-to-back
+    # single notes are checked.
+    patterns = lane_patterns(lane_count)
+    kept = np.searchsorted(times, unique_times)
+    pattern_lanes = patterns[kept % len(patterns), np.arange(1, len(kept) + 1) % patterns.shape[1]]
+    lanes = note_lanes[np.searchsorted(note_times, unique_times)]
+    single = counts == 1
+    repeats = single[1:] & single[:-1] & (lanes[1:] == lanes[:-1])
+    if np.any(repeats & (lanes[1:] != pattern_lanes[1:])):
+        problems.append('random lane repeating the previous one')
+
+    if not np.all((note_lanes >= 0) & (note_lanes < lane_count)):
+        problems.append('lane out of range')
+    return problems
+
+
+def best_of(fn, repeat):
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark lane assignment against the original loop')
+    parser.add_argument('--minutes', type=float, default=10.0, help='Synthetic track length (default: 10)')
+    parser.add_argument('--nps', type=float, default=16.0, help='Candidate notes per second (default: 16)')
+    parser.add_argument('--difficulty', default='expert', help='Difficulty settings to use (default: expert)')
+    parser.add_argument('--lanes', type=int, choices=LANE_COUNTS, default=4, help='Key mode (default: 4)')
+    parser.add_argument('--repeat', type=int, default=3, help='Timing repeats, best is reported (default: 3)')
+    parser.add_argument('--seed', type=int, default=0, help='RNG seed (default: 0)')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    duration = args.minutes * 60.0
+    times = np.sort(np.round(rng.uniform(0, duration, int(duration * args.nps)), 3))
+    hit_classes = rng.integers(0, 3, len(times)).astype(np.uint8)
+    print(f"Candidate notes: {len(times)}")
+
+    np.random.seed(args.seed)
+    ref_time, reference = best_of(lambda: assign_lanes_reference(times, args.difficulty, hit_classes), 1)
+    fast_time, notes = best_of(
+        lambda: assign_lanes_array(times, args.difficulty, hit_classes, seed=args.seed, lane_count=args.lanes),
+        args.repeat
+    )
+    dicts_time, _ = best_of(lambda: notes_as_dicts(notes), args.repeat)
+
+    problems = check_chart(notes, reference, times, args.lanes)
+    again = assign_lanes_array(times, args.difficulty, hit_classes, seed=args.seed, lane_count=args.lanes)
+    if not np.array_equal(again, notes):
+        problems.append('same seed gave a different chart')
+
+    print(f"\n{'function':<16}{'original':>12}{'vectorized':>12}{'speedup':>10}  sound")
+    print(f"{'assign_lanes':<16}{ref_time * 1000:>10.1f}ms{fast_time * 1000:>10.2f}ms"
+          f"{ref_time / fast_time:>9.0f}x  {'yes' if not problems else 'NO'}")
+    print(f"\nnotes_as_dicts (at save time only): {dicts_time * 1000:.2f}ms")
+
+    if problems:
+        print("\n" + "\n".join(problems))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+"""
+Beatmap files shared by the generator and the gameplay simulator.
+
+read_chart loads every format save_beatmap writes; SONGS_DIR is the
+bundled song library. Kept apart from beatmap_generator.py so that
+gameplay_sim.py can read charts without importing the generator, which
+imports the simulator for its catalog ratings.
+"""
+
+import json
+from pathlib import Path
+
+import numpy as np
+
+# Bundled song library (see build_library)
+SONGS_DIR = Path(__file__).resolve().parent.parent / 'assets' / 'songs'
+
+
+def read_chart(beatmap_path, with_durations=False):
+    """
+    Load any beatmap save_beatmap writes (legacy, compact or segmented).
+
+    Returns (metadata, times, lanes): metadata is every top-level field
+    except the note data, times are seconds. with_durations adds a fourth
+    array of hold lengths in seconds (0 for taps).
+    """
+    beatmap_path = Path(beatmap_path)
+    with open(beatmap_path) as f:
+        data = json.load(f)
+
+    if 'segments' in data:
+        times_ms, lanes, durations_ms = [], [], []
+        for segment in data['segments']:
+            with open(beatmap_path.parent / segment['path']) as f:
+                segment_data = json.load(f)
+            times_ms.extend(segment_data['timesMs'])
+            lanes.extend(segment_data['lanes'])
+            durations_ms.extend(segment_data.get('durationsMs', [0] * len(segment_data['timesMs'])))
+        times = np.asarray(times_ms, dtype=float) / 1000.0
+        durations = np.asarray(durations_ms, dtype=float) / 1000.0
+    elif 'timesMs' in data:
+        times = np.asarray(data['timesMs'], dtype=float) / 1000.0
+        lanes = data['lanes']
+        durations = np.asarray(data.get('durationsMs', np.zeros(len(times))), dtype=float) / 1000.0
+    else:
+        times = np.array([note['time'] for note in data.get('notes', [])], dtype=float)
+        lanes = [note['lane'] for note in data.get('notes', [])]
+        durations = np.array([note.get('duration', 0) for note in data.get('notes', [])], dtype=float)
+
+    metadata = {k: v for k, v in data.items() if k not in ('notes', 'timesMs', 'lanes', 'durationsMs', 'segments')}
+    if with_durations:
+        return metadata, times, np.asarray(lanes, dtype=np.int64), durations
+    return metadata, times, np.asarray(lanes, dtype=np.int64)
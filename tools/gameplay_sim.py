@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""
+Headless gameplay simulator: how playable is a chart?
+
+Replays charts against synthetic players using GameplayScene.brs's
+judging rules, without a TV. Each player model turns every note into a
+key press with a timing error (and, for holds, a release). Judgments,
+combo and score are then worked out with array operations for many runs
+at once, so thousands of charts can be scored per minute.
+
+Player models:
+    perfect  - presses exactly on time
+    jittered - Gaussian timing error (--sigma-ms, --bias-ms)
+    human    - jittered, but error grows and presses get skipped as the
+               local note density passes what the player can read
+               (--skill-nps); chords are a little sloppier
+
+The vectorized judge grades each press against its own note. The game
+grades a press against the closest unhit note in its lane instead, which
+only differs when a press strays more than half the gap to a neighbour
+in the same lane; --check replays one run through judge_reference, a
+literal port of pressLane/checkMissedNotes, and reports any disagreement.
+
+build-catalog and build-library store measured_rating's stars as each
+song_index.json entry's measuredRating, next to the difficultyRating
+song select shows. That one comes from the chart's notes (see
+get_difficulty_rating) and is shown in the "stars" column.
+
+Usage: python tools/gameplay_sim.py [beatmap.json ...] [--model human] [--runs 200]
+       (no paths: every assets/songs/*/beatmap.json)
+"""
+
+import argparse
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+
+from chart_io import SONGS_DIR, read_chart
+
+# Judging constants, as in GameplayScene.brs init() / calculateLayout()
+PERFECT_WINDOW = 0.08
+GREAT_WINDOW = 0.15
+GOOD_WINDOW = 0.25
+MISS_WINDOW = 0.35
+HOLD_RELEASE_WINDOW = 0.15
+PERFECT_POINTS = 300
+GREAT_POINTS = 200
+GOOD_POINTS = 100
+HOLD_POINTS = 100
+TICK = 0.016
+# checkMissedNotes drops a note int(0.2 * height) px past the hit line;
+# notes fall int(0.7 * height) px/s, so at 720p that is 144 / 504 s
+SCREEN_HEIGHT = 720
+MISS_DELAY = int(SCREEN_HEIGHT * 0.20) / int(SCREEN_HEIGHT * 0.7)
+
+# Judgment codes
+PERFECT = 0
+GREAT = 1
+GOOD = 2
+MISS = 3
+JUDGMENT_NAMES = ['perfect', 'great', 'good', 'miss']
+
+MODELS = ['perfect', 'jittered', 'human']
+
+
+def local_nps(times, window=1.0):
+    """Notes within +-window/2 seconds of each note, per second."""
+    half = window / 2
+    return (np.searchsorted(times, times + half, side='right')
+            - np.searchsorted(times, times - half, side='left')) / window
+
+
+def player_inputs(times, model='human', runs=100, sigma_ms=30.0, bias_ms=0.0, skill_nps=6.0, seed=0):
+    """
+    Timing error of every press for each run, shape (runs, notes).
+
+    NaN marks a note the player didn't press. Releases of holds use the
+    same error distribution (see simulate).
+    """
+    rng = np.random.default_rng(seed)
+    n = len(times)
+    if model == 'perfect':
+        return np.zeros((runs, n))
+
+    sigma = np.full(n, sigma_ms / 1000.0)
+    skip = np.zeros(n)
+    if model == 'human':
+        density = local_nps(times)
+        overload = np.maximum(density / skill_nps - 1.0, 0.0)
+        sigma = sigma * (1.0 + overload)
+        # Chord notes share a time with another note
+        unique_times, counts = np.unique(times, return_counts=True)
+        in_chord = counts[np.searchsorted(unique_times, times)] > 1
+        sigma = np.where(in_chord, sigma * 1.25, sigma)
+        skip = np.minimum(0.5 * overload, 0.9)
+    elif model != 'jittered':
+        raise ValueError(f"unknown player model: {model}")
+
+    errors = rng.normal(bias_ms / 1000.0, sigma, (runs, n))
+    errors[rng.random((runs, n)) < skip] = np.nan
+    return errors
+
+
+def judge(errors):
+    """Judgment codes for press timing errors (NaN = no press -> miss)."""
+    # Late presses past MISS_DELAY find the note already auto-missed, early
+    # ones before -MISS_WINDOW find nothing: a miss either way
+    off = np.abs(errors)
+    return np.select(
+        [off <= PERFECT_WINDOW, off <= GREAT_WINDOW, off <= GOOD_WINDOW],
+        [PERFECT, GREAT, GOOD],
+        MISS
+    ).astype(np.uint8)
+
+
+def _auto_miss_delay():
+    # The miss shows up on the first 16 ms tick after MISS_DELAY has passed
+    return (np.floor(MISS_DELAY / TICK) + 1) * TICK
+
+
+def simulate(times, lanes, durations=None, model='human', runs=100, seed=0, **model_args):
+    """
+    Play a chart `runs` times and score every run like GameplayScene does.
+
+    Returns a dict of per-run arrays: 'accuracy' (percent), 'score',
+    'maxCombo', and 'judgments' (runs x 4 counts, see JUDGMENT_NAMES).
+    """
+    times = np.asarray(times, dtype=float)
+    n = len(times)
+    durations = np.zeros(n) if durations is None else np.asarray(durations, dtype=float)
+    errors = player_inputs(times, model, runs, seed=seed, **model_args)
+    judgments = judge(errors)
+    hit = judgments != MISS
+
+    # Event stream per run: every judgment plus, for holds whose head was
+    # hit, a completion (bonus, combo kept) or a drop (combo broken)
+    pressed = np.where(np.isnan(errors), _auto_miss_delay(), np.where(hit, errors, np.maximum(errors, -MISS_WINDOW)))
+    event_times = [times + pressed]
+    kinds = [judgments]
+    is_hold = durations > 0
+    if is_hold.any():
+        release_errors = player_inputs(times[is_hold], model, runs, seed=seed + 1, **model_args)
+        # An unpressed release (NaN) means the key was let go at once
+        release = np.where(np.isnan(release_errors), -durations[is_hold], release_errors)
+        dropped = release < -HOLD_RELEASE_WINDOW
+        ends = times[is_hold] + durations[is_hold]
+        event_times.append(np.where(dropped, ends + release, ends) + np.zeros((runs, 1)))
+        # Holds whose head missed never start: code 255 is ignored below
+        kinds.append(np.where(hit[:, is_hold], np.where(dropped, MISS + 1, MISS + 2), 255).astype(np.uint8))
+    event_times = np.concatenate(event_times, axis=1)
+    kinds = np.concatenate(kinds, axis=1)
+
+    order = np.argsort(event_times, axis=1, kind='stable')
+    kinds = np.take_along_axis(kinds, order, axis=1)
+
+    # combo after each event: hits since the last miss/drop
+    increments = (kinds <= GOOD).astype(np.int64)
+    resets = (kinds == MISS) | (kinds == MISS + 1)
+    running = np.cumsum(increments, axis=1)
+    last_reset = np.maximum.accumulate(np.where(resets, np.arange(kinds.shape[1]), -1), axis=1)
+    base = np.where(last_reset >= 0, np.take_along_axis(running, np.maximum(last_reset, 0), axis=1), 0)
+    combo = running - base
+
+    points = np.select(
+        [kinds == PERFECT, kinds == GREAT, kinds == GOOD, kinds == MISS + 2],
+        [PERFECT_POINTS, GREAT_POINTS, GOOD_POINTS, HOLD_POINTS],
+        0
+    )
+    score = np.floor(points * (1.0 + combo * 0.01)).astype(np.int64).sum(axis=1)
+
+    counts = np.stack([(judgments == j).sum(axis=1) for j in range(4)], axis=1)
+    judged = counts.sum(axis=1)
+    accuracy = np.where(
+        judged > 0,
+        (counts[:, PERFECT] * 100.0 + counts[:, GREAT] * 75.0 + counts[:, GOOD] * 50.0) / np.maximum(judged, 1),
+        100.0
+    )
+    return {
+        'accuracy': accuracy,
+        'score': score,
+        'maxCombo': combo.max(axis=1, initial=0),
+        'judgments': counts,
+    }
+
+
+def simulate_notes(notes, model='human', runs=100, seed=0, **model_args):
+    """simulate() over a generate_chart / generate_notes structured array."""
+    return simulate(notes['time'], notes['lane'], notes['duration'], model, runs, seed, **model_args)
+
+
+def grade(accuracy):
+    """calculateGrade() in GameplayScene.brs."""
+    for threshold, letter in ((95, 'S'), (90, 'A'), (80, 'B'), (70, 'C'), (60, 'D')):
+        if accuracy >= threshold:
+            return letter
+    return 'F'
+
+
+def measured_stars(accuracy):
+    """Star rating from human-model accuracy: 1 star at >= 97%, 7 at <= 70%."""
+    return int(np.clip(round(1 + 6 * (97.0 - accuracy) / 27.0), 1, 7))
+
+
+def measured_rating(times, lanes, durations=None, runs=200, seed=0):
+    """
+    Mean human-model accuracy (percent) over `runs` seeded runs and the
+    star rating it measures; refresh_catalog_entry stores both.
+    """
+    accuracy = float(simulate(times, lanes, durations, model='human', runs=runs, seed=seed)['accuracy'].mean())
+    return accuracy, measured_stars(accuracy)
+
+
+def judge_reference(times, lanes, errors):
+    """
+    One run through a literal port of pressLane / checkMissedNotes.
+
+    errors: per-note press timing error (NaN = not pressed). Presses and
+    16 ms ticks are processed in time order; a press judges the closest
+    unhit note in its lane within MISS_WINDOW. Returns judgment codes per
+    note (holds are not modelled here).
+    """
+    n = len(times)
+    result = np.full(n, MISS, dtype=np.uint8)
+    pending = set(range(n))
+    presses = sorted((times[i] + errors[i], i) for i in range(n) if not np.isnan(errors[i]))
+    p = 0
+    tick = 0.0
+    end = (times.max() if n else 0.0) + 1.0
+    while tick <= end:
+        tick += TICK
+        # Key events that arrived before this tick
+        while p < len(presses) and presses[p][0] <= tick:
+            press_time, i = presses[p]
+            p += 1
+            candidates = [j for j in pending if lanes[j] == lanes[i]]
+            if not candidates:
+                continue
+            closest = min(candidates, key=lambda j: abs(times[j] - press_time))
+            diff = abs(times[closest] - press_time)
+            if diff <= MISS_WINDOW:
+                result[closest] = judge(np.array([diff]))[0]
+                pending.discard(closest)
+        for j in [j for j in pending if tick - times[j] > MISS_DELAY]:
+            pending.discard(j)
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Score charts against synthetic players')
+    parser.add_argument('beatmaps', nargs='*', type=Path,
+                        help='Beatmap files (default: every assets/songs/*/beatmap.json)')
+    parser.add_argument('--model', choices=MODELS, default='human', help='Player model (default: human)')
+    parser.add_argument('--runs', type=int, default=200, help='Runs per chart (default: 200)')
+    parser.add_argument('--sigma-ms', type=float, default=30.0, help='Timing error std. dev. (default: 30)')
+    parser.add_argument('--bias-ms', type=float, default=0.0, help='Mean timing error, + = late (default: 0)')
+    parser.add_argument('--skill-nps', type=float, default=6.0,
+                        help='Density the human model reads comfortably, notes/s (default: 6)')
+    parser.add_argument('--seed', type=int, default=0, help='RNG seed (default: 0)')
+    parser.add_argument('--gate', type=float, metavar='ACCURACY',
+                        help='Exit non-zero if any chart\'s mean accuracy is below this percent')
+    parser.add_argument('--check', action='store_true',
+                        help='Compare one run per chart with the literal pressLane port')
+    args = parser.parse_args()
+
+    paths = args.beatmaps or sorted(SONGS_DIR.glob('*/beatmap.json'))
+    model_args = {'sigma_ms': args.sigma_ms, 'bias_ms': args.bias_ms, 'skill_nps': args.skill_nps}
+
+    print(f"{'chart':<36}{'notes':>7}{'accuracy':>10}{'grade':>7}{'max combo':>11}{'FC rate':>9}"
+          f"{'stars':>7}{'measured':>10}")
+    failed = []
+    start = time.perf_counter()
+    for path in paths:
+        metadata, times, lanes, durations = read_chart(path, with_durations=True)
+        result = simulate(times, lanes, durations, model=args.model, runs=args.runs, seed=args.seed,
+                          **model_args)
+        accuracy = result['accuracy'].mean()
+        full_combo = np.mean(result['judgments'][:, MISS] == 0)
+        name = path.parent.name if path.name == 'beatmap.json' else path.name
+        print(f"{name:<36}{len(times):>7}{accuracy:>9.2f}%{grade(accuracy):>7}"
+              f"{result['maxCombo'].mean():>11.0f}{full_combo:>9.0%}"
+              f"{metadata.get('difficultyRating', '-'):>7}{measured_stars(accuracy):>10}")
+        if args.gate is not None and accuracy < args.gate:
+            failed.append(name)
+
+        if args.check:
+            errors = player_inputs(times, args.model, 1, seed=args.seed, **model_args)[0]
+            differ = np.count_nonzero(judge(errors) != judge_reference(times, lanes, errors))
+            print(f"{'':<36}check: {differ} of {len(times)} judgments differ from the pressLane port")
+
+    elapsed = time.perf_counter() - start
+    print(f"\n{len(paths)} chart(s) x {args.runs} runs in {elapsed:.2f}s")
+    if failed:
+        print(f"Below {args.gate:g}% accuracy: {', '.join(failed)}")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()